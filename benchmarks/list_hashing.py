@@ -0,0 +1,68 @@
+"""
+Measures how `snipty list` hashing scales with number of workers.
+
+    $ python benchmarks/list_hashing.py --snippets 50 --files 10 --size 1048576
+
+Creates a temporary project with multi file snippets and prints list time for 1..N workers.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import yaml
+
+from snipty.base import Snipty
+
+
+def create_project(project_root, snippets, files, size):
+    config = {}
+    for snippet in range(snippets):
+        name = "snippets/s{}".format(snippet)
+        os.makedirs(os.path.join(project_root, name))
+        for file_number in range(files):
+            with open(
+                os.path.join(project_root, name, "f{}".format(file_number)), "wb"
+            ) as f:
+                f.write(os.urandom(size))
+        config[name] = "https://example.com/{}".format(snippet)
+
+    with open(os.path.join(project_root, "snipty.yml"), "w") as f:
+        yaml.dump(config, f, default_flow_style=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--snippets", type=int, default=50)
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--size", type=int, default=1024 * 1024)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as project_root:
+        create_project(project_root, args.snippets, args.files, args.size)
+
+        workers = 1
+        baseline = None
+        expected = None
+        while workers <= args.max_workers:
+            # Fresh instance - no digests cached between runs
+            started = time.perf_counter()
+            result = Snipty(project_root).list(workers=workers)
+            elapsed = time.perf_counter() - started
+
+            baseline = baseline or elapsed
+            expected = expected or result
+            assert result == expected, "parallel result differs from serial one"
+
+            print(
+                "workers={:<3} {:.3f}s  speedup {:.2f}x".format(
+                    workers, elapsed, baseline / elapsed
+                )
+            )
+            workers *= 2
+
+
+if __name__ == "__main__":
+    main()
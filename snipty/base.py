@@ -1,7 +1,9 @@
-import filecmp
-import hashlib
 import shutil
-from typing import Union
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Union
 
 import yaml
 import logging
@@ -12,16 +14,47 @@ from functools import wraps
 
 from termcolor import colored
 
+from snipty.bundle import BundleError, create_bundle, restore_bundle
+from snipty.compare import (
+    DigestCache,
+    compare_files,
+    compare_trees,
+    is_binary,
+    tree_digest,
+    tree_files,
+)
 from snipty.downloaders import (
     BasicDownloader,
     BaseDownloader,
     DownloaderError,
+    DownloadPolicy,
     GhostbinDownloader,
     GistDownloader,
+    GitDownloader,
+    NOT_MODIFIED,
+    SingleFlight,
+    current_run,
+    remove_path,
 )
+from snipty.git import GitError, staged_paths
+from snipty.metrics import Metrics, path_size, recording, url_host
+from snipty.mirror import MirrorRefusedError, fetch_from_mirror, mirrorable
+from snipty.results import CheckResult, FileResult, FileStatus, SnippetStatus
+from snipty.state import STATE_FILE_NAME, SniptyState
 
 logger = logging.getLogger("snipty")
 
+# Seconds after which snippet verified by incremental check is verified again
+DEFAULT_MAX_AGE = 3600
+# Larger text files are not diffed line by line (keeps memory and time of --diff bounded)
+DEFAULT_DIFF_LIMIT = 1024 * 1024
+
+# Safety margin (seconds) for clock differences with upstream when probing for recent changes
+PROBE_CLOCK_SKEW = 300
+
+# Serializes diffs printed by snipty instances checking roots concurrently
+_diff_output_lock = threading.Lock()
+
 
 class ConfigNotExists(Exception):
     pass
@@ -36,10 +69,11 @@ class SniptyCriticalError(Exception):
 def ensure_config_saved(f):
     @wraps(f)
     def wrapped(self, *args, **kwargs):
-        try:
-            return f(self, *args, **kwargs)
-        finally:
-            self.store_config()
+        with self._config_lock:
+            try:
+                return f(self, *args, **kwargs)
+            finally:
+                self.store_config()
 
     return wrapped
 
@@ -60,14 +94,55 @@ def ensure_config_exists(f):
     return wrapped
 
 
+def within_run(f):
+    """
+    Run method as a single run (see `SingleFlight`) - `downloads` if given or a fresh one.
+
+    Nested calls and calls made while other run is active in the thread join it.
+    """
+
+    @wraps(f)
+    def wrapped(self, *args, **kwargs):
+        if current_run() is not None:
+            return f(self, *args, **kwargs)
+        if self.downloads is not None:
+            with self.downloads.activated():
+                return f(self, *args, **kwargs)
+        with SingleFlight() as downloads, downloads.activated():
+            return f(self, *args, **kwargs)
+
+    return wrapped
+
+
 class Snipty:
     """Manages whole process of tracking what is installed and calling specialized downloaders"""
 
-    SUPPORTED_DOWNLOADERS = [GistDownloader, GhostbinDownloader, BasicDownloader]
-
-    def __init__(self, project_root):
+    SUPPORTED_DOWNLOADERS = [
+        GitDownloader,
+        GistDownloader,
+        GhostbinDownloader,
+        BasicDownloader,
+    ]
+
+    def __init__(
+        self,
+        project_root,
+        downloads=None,
+        metrics: Metrics = None,
+        policy: DownloadPolicy = None,
+    ):
         self.project_root = project_root
+        self.downloads = downloads
+        self.metrics = metrics if metrics is not None else Metrics()
+        # Size limits of downloads; share one instance to limit bytes of a whole run
+        self.policy = (
+            policy if policy is not None else DownloadPolicy.from_environment()
+        )
         self._config = None
+        self._config_signature = None
+        # Guards config cache so a single instance can be shared by many threads
+        self._config_lock = threading.RLock()
+        self._digests = DigestCache()
 
     # Helpers
 
@@ -83,6 +158,73 @@ class Snipty:
         logger.error("Error: cannot find downloader for provided url {}".format(url))
         raise SniptyCriticalError(4)
 
+    def _download(self, url: str) -> str:
+        """Download snippet coalescing requests within the current run (`SingleFlight`)"""
+
+        run = current_run()
+        if run is None:
+            return self._fetch(url)
+
+        fetched = []
+
+        def fetch():
+            fetched.append(url)
+            return self._fetch(url)
+
+        key = self._dispatch_url(url).normalize_url(url)
+        tmp_path = run.download(key, fetch)
+        if not fetched:
+            self.metrics.inc("snipty_download_cache_hits_total")
+        return tmp_path
+
+    def _fetch(self, url: str) -> str:
+        """
+        Download snippet through SNIPTY_MIRROR (if set) falling back to the origin.
+
+        Urls the mirror cannot serve (e.g. local git repositories) are never sent to it.
+        """
+
+        downloader_class = self._dispatch_url(url)
+
+        mirror_url = os.environ.get("SNIPTY_MIRROR")
+        if mirror_url and mirrorable(url):
+            try:
+                return self._measured_download(
+                    "mirror", mirror_url, lambda: fetch_from_mirror(mirror_url, url)
+                )
+            except MirrorRefusedError as e:
+                # Refused by mirror policy, not a failure worth retrying or alerting on
+                logger.info("{}; downloading from origin.".format(str(e).capitalize()))
+            except DownloaderError as e:
+                logger.warning(
+                    "Mirror {} failed - {}; falling back to origin.".format(
+                        mirror_url, str(e)
+                    )
+                )
+                self.metrics.inc("snipty_download_retries_total", reason="mirror")
+
+        return self._measured_download(
+            downloader_class.__name__, url, lambda: downloader_class.download(url=url)
+        )
+
+    def _measured_download(self, downloader: str, url: str, download) -> str:
+        """Call `download()` within `policy` limits recording its duration, size and HTTP responses"""
+        labels = dict(downloader=downloader, host=url_host(url))
+        started = time.monotonic()
+
+        with recording(self.metrics), self.policy.downloading():
+            try:
+                tmp_path = download()
+            except DownloaderError:
+                self.metrics.inc("snipty_download_errors_total", **labels)
+                raise
+
+        self.metrics.observe(
+            "snipty_download_duration_seconds", time.monotonic() - started, **labels
+        )
+        self.metrics.inc("snipty_download_bytes_total", path_size(tmp_path), **labels)
+        return tmp_path
+
     def _prepare_directory(self, root_path, package_dir, create_init_py=False):
         """Create a tree of directories and place __init__.py files"""
         full_path = os.path.join(root_path, package_dir)
@@ -102,6 +244,8 @@ class Snipty:
         """
         Installs single package from url
         """
+        self._package_destination(name)
+
         if not force and name in self.config(create=True):
             logger.warning("Snippet '{}' has been already installed.".format(name))
             raise SniptyCriticalError(3)
@@ -122,16 +266,39 @@ class Snipty:
             )
             raise SniptyCriticalError(3)
 
-        downloader_class = self._dispatch_url(url)
-
         try:
-            tmp_path = downloader_class.download(url=url)
+            tmp_path = self._download(url)
         except DownloaderError as e:
             logger.error(
                 "Error: Snippet {} cannot be installed - {}.".format(name, str(e))
             )
             raise SniptyCriticalError(6)
 
+        self._place_package(name, tmp_path)
+
+        self.config(create=True)[name] = url
+
+        logger.info("✔️ Snippet {} installed from {}".format(name, url))
+
+    def _package_destination(self, name: str) -> str:
+        """Location of snippet in the codebase; refuses names of project root itself or outside of it"""
+        root = os.path.realpath(self.project_root)
+        destination = os.path.realpath(os.path.join(root, name))
+        if destination == root or os.path.commonpath([root, destination]) != root:
+            logger.error(
+                "Error: Cannot install snippet '{}' outside of project root.".format(
+                    name
+                )
+            )
+            raise SniptyCriticalError(3)
+        return destination
+
+    def _place_package(self, name: str, tmp_path: str):
+        """Move downloaded snippet from temporary location into the codebase"""
+
+        # Checked before anything is removed (e.g. name "." would remove whole project root)
+        destination = self._package_destination(name)
+
         # tmp_path can be a single file or directory (support for snippets containing many files)
 
         if os.path.isdir(tmp_path):
@@ -141,71 +308,167 @@ class Snipty:
             package_dir = os.path.dirname(name)
             package_name = os.path.basename(name)
 
+        # Previous version is replaced as a whole, files removed from the source must not survive
+        remove_path(destination)
+
         self._prepare_directory(
             self.project_root, package_dir, create_init_py=name.endswith(".py")
         )
 
         if package_name is not None:
-            os.rename(
+            shutil.move(
                 tmp_path, os.path.join(self.project_root, package_dir, package_name)
             )
         else:
+            # Moved entry by entry, so the snippet directory gets usual permissions (not these of mkdtemp)
             for file_name in os.listdir(tmp_path):
-                os.rename(
+                shutil.move(
                     os.path.join(tmp_path, file_name),
                     os.path.join(self.project_root, package_dir, file_name),
                 )
+            os.rmdir(tmp_path)
 
-        self.config(create=True)[name] = url
-
-        logger.info("✔️ Snippet {} installed from {}".format(name, url))
+        self.metrics.inc("snipty_snippets_installed_total")
 
     @ensure_config_saved
+    @within_run
     def install_package(self, url, name, force=False):
         self._install_package(url, name, force=force)
 
     def _package_is_installed(self, name: str) -> bool:
-        fname = os.path.join(self.project_root, name)
-        return os.path.isfile(fname)
+        # Multi file snippets are directories
+        return os.path.exists(os.path.join(self.project_root, name))
 
     @ensure_config_exists
     @ensure_config_saved
-    def install_missing(self, force=False):
-        installed_anything = False
-        for name, url in self.config().items():
-            if force or not self._package_is_installed(name):
-                self._install_package(name=name, url=url, force=True)
-                installed_anything = True
+    @within_run
+    def install_missing(self, force=False, bundle=None, names=None):
+        """
+        Install snippets that are tracked but not present in the codebase.
 
-        if not installed_anything:
+        With `bundle` snippets are restored from an archive created by `bundle()` without touching
+        the network. `names` limits installation to selected snippets.
+        """
+        if names is not None:
+            for name in names:
+                if name not in self.config():
+                    logger.error("Error: Snippet {} is not tracked.".format(name))
+                    raise SniptyCriticalError(1)
+
+        missing = [
+            name
+            for name in self.config()
+            if (names is None or name in names)
+            and (force or not self._package_is_installed(name))
+        ]
+
+        if not missing:
             logger.warning("No missing snippets to install!")
+        elif bundle is not None:
+            self._install_from_bundle(bundle, missing)
+        else:
+            for name in missing:
+                self._install_package(name=name, url=self.config()[name], force=True)
+
+    def _install_from_bundle(self, bundle_path: str, names):
+        staging_directory = tempfile.mkdtemp(dir=os.environ.get("SNIPTY_TMP"))
+        try:
+            try:
+                restored = restore_bundle(bundle_path, staging_directory, names=names)
+            except BundleError as e:
+                logger.error("Error: Snippets cannot be restored - {}.".format(str(e)))
+                raise SniptyCriticalError(6)
+
+            for name in names:
+                url, tmp_path = restored[name]
+                if url != self.config()[name]:
+                    logger.error(
+                        "Error: Snippet {} was bundled from different url {}.".format(
+                            name, url
+                        )
+                    )
+                    raise SniptyCriticalError(6)
+
+            for name in names:
+                self._place_package(name, restored[name][1])
+                logger.info(
+                    "✔️ Snippet {} restored from bundle {}".format(name, bundle_path)
+                )
+        finally:
+            shutil.rmtree(staging_directory, ignore_errors=True)
+
+    # Command: Bundle
+
+    @ensure_config_exists
+    def bundle(self, out_path: str):
+        """Pack all installed snippets into a single archive usable by `install_missing`"""
+
+        snippets = {}
+        for name, url in self.config().items():
+            if os.path.exists(self._get_package_full_path(name)):
+                snippets[name] = url
+            else:
+                logger.warning(
+                    "❌ Snippet {} is not installed and will not be bundled.".format(
+                        name
+                    )
+                )
+
+        create_bundle(out_path, self.project_root, snippets)
+        logger.info("✔ Bundled {} snippets into {}".format(len(snippets), out_path))
 
     # Command: List
 
-    def _package_checksum(self, path: str) -> Union[str, None]:
-        fname = os.path.join(self.project_root, path)
-        h = hashlib.sha1()
-
-        if os.path.isfile(fname):
-            with open(fname, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    h.update(chunk)
-            return h.hexdigest()
-
-        elif os.path.isdir(fname):
-            for package_file in os.listdir(fname):
-                with open(os.path.join(fname, package_file), "rb") as f:
-                    for chunk in iter(lambda: f.read(4096), b""):
-                        h.update(chunk)
-            return h.hexdigest()
+    def _path_checksum(
+        self, full_path: str, digests: DigestCache = None
+    ) -> Union[str, None]:
+        digests = DigestCache() if digests is None else digests
+
+        if os.path.isfile(full_path):
+            return digests.digest(full_path)
+        elif os.path.isdir(full_path):
+            return tree_digest(full_path, digests)
         else:
             return None
 
+    def _package_checksum(self, path: str) -> Union[str, None]:
+        return self._path_checksum(
+            os.path.join(self.project_root, path), digests=self._digests
+        )
+
+    def _compute_digests(self, names, workers: int):
+        """Digest files of many packages concurrently so checksums are then served from cache"""
+        paths = []
+        for name in names:
+            full_path = self._get_package_full_path(name)
+            if os.path.isfile(full_path):
+                paths.append(full_path)
+            elif os.path.isdir(full_path):
+                paths.extend(tree_files(full_path).values())
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # hashlib releases GIL while digesting large buffers so threads scale across cores
+            for _ in executor.map(self._digests.digest, paths):
+                pass
+
     @ensure_config_exists
-    def list(self):
+    def list(self, workers: int = 1, names=None):
+        """
+        Lists tracked packages (or only selected `names`) with checksums of installed ones.
+
+        With `workers` > 1 files are digested concurrently; result is identical to serial run.
+        """
         result = {"installed": [], "not_installed": []}
+        packages = [
+            (package, url)
+            for package, url in self.config().items()
+            if names is None or package in names
+        ]
+
+        if workers > 1:
+            self._compute_digests([package for package, url in packages], workers)
 
-        for package, url in self.config().items():
+        for package, url in packages:
             package_hash = self._package_checksum(package)
             if package_hash is None:
                 result["not_installed"].append((package, url))
@@ -214,6 +477,59 @@ class Snipty:
 
         return result
 
+    @ensure_config_exists
+    def tracked_snippets(self) -> List[str]:
+        return list(self.config())
+
+    # Scoping to changed paths
+
+    @ensure_config_exists
+    def affected_snippets(self, paths) -> List[str]:
+        """
+        Names of tracked snippets containing any of `paths` (absolute or relative to project root).
+
+        Change of snipty.yml itself affects all snippets. Paths outside of project root are reported and
+        ignored.
+        """
+        index = {
+            os.path.normpath(name).replace(os.sep, "/"): name for name in self.config()
+        }
+        root = os.path.abspath(self.project_root)
+        affected = set()
+
+        for path in paths:
+            relative_path = os.path.relpath(os.path.join(root, path), root)
+            parts = relative_path.replace(os.sep, "/").split("/")
+
+            if parts[0] == "..":
+                logger.warning(
+                    "Path {} is outside of project root {}, ignoring it.".format(
+                        path, self.project_root
+                    )
+                )
+                continue
+            if relative_path == os.path.basename(self.config_file_path):
+                return list(self.config())
+
+            # Snippet can be a file or a directory so look up every leading part of the path
+            for depth in range(1, len(parts) + 1):
+                name = index.get("/".join(parts[:depth]))
+                if name is not None:
+                    affected.add(name)
+                    break
+
+        return [name for name in self.config() if name in affected]
+
+    def staged_snippets(self) -> List[str]:
+        """Names of tracked snippets affected by files staged for commit in git"""
+        try:
+            paths = staged_paths(self.project_root)
+        except GitError as e:
+            logger.error("Error: Cannot get staged files - {}.".format(str(e)))
+            raise SniptyCriticalError(1)
+
+        return self.affected_snippets(paths)
+
     # Command: Uninstall
 
     @ensure_config_exists
@@ -250,127 +566,426 @@ class Snipty:
 
     # Command: Check
 
-    def _print_diff(self, old_path, new_path):
-        d = Differ()
-
-        with open(old_path, "r") as old_file:
-            with open(new_path, "r") as new_file:
+    def _print_diff(self, old_path, new_path, diff_limit=DEFAULT_DIFF_LIMIT):
+        """Print line diff of text files; binary and larger than `diff_limit` files are only described"""
+        lines = ["Diff of {}:".format(old_path)]
 
-                old_content = old_file.read()
-                new_content = new_file.read()
+        sizes = os.path.getsize(old_path), os.path.getsize(new_path)
+        if is_binary(old_path) or is_binary(new_path):
+            lines.append("  Binary files differ.")
 
-                result = list(
-                    d.compare(old_content.split("\n"), new_content.split("\n"))
+        elif diff_limit is not None and max(sizes) > diff_limit:
+            lines.append(
+                "  Files are too large to diff ({} and {} bytes, limit {}).".format(
+                    sizes[0], sizes[1], diff_limit
                 )
+            )
 
-                for line in result:
-                    if line.startswith("+ "):
-                        print(colored(line, "green"), file=sys.stderr)
-                    elif line.startswith("- "):
-                        print(colored(line, "red"), file=sys.stderr)
+        else:
+            d = Differ()
+
+            with open(old_path, "r", encoding="utf-8", errors="replace") as old_file:
+                with open(
+                    new_path, "r", encoding="utf-8", errors="replace"
+                ) as new_file:
+
+                    old_content = old_file.read()
+                    new_content = new_file.read()
+
+                    for line in d.compare(
+                        old_content.split("\n"), new_content.split("\n")
+                    ):
+                        if line.startswith("+ "):
+                            lines.append(colored(line, "green"))
+                        elif line.startswith("- "):
+                            lines.append(colored(line, "red"))
+                        else:
+                            lines.append(line)
+
+        with _diff_output_lock:
+            sys.stderr.write("\n".join(lines) + "\n")
+            sys.stderr.flush()
+
+    def _compare_package(
+        self,
+        name: str,
+        tmp_path: str,
+        print_diff: bool,
+        diff_limit: int = DEFAULT_DIFF_LIMIT,
+    ):
+        """Compare installed package with downloaded one; returns `(status, file results, difference offset)`"""
+
+        snippet_path = os.path.join(self.project_root, name)
+
+        if os.path.isdir(tmp_path) and os.path.isdir(snippet_path):
+            # Compare two directories
+
+            result = compare_trees(snippet_path, tmp_path, self._digests)
+
+            files = [FileResult(f, FileStatus.SAME) for f in result.same]
+            files += [FileResult(f, FileStatus.CHANGED) for f in result.changed]
+            files += [FileResult(f, FileStatus.ADDED) for f in result.added]
+            files += [FileResult(f, FileStatus.REMOVED) for f in result.removed]
+            files.sort()
+
+            if result.has_changes:
+                for f, status in files:
+                    if status == FileStatus.SAME:
+                        logger.info(
+                            "✔ Snippet {} file {} did not changed.".format(name, f)
+                        )
+                    elif status == FileStatus.CHANGED:
+                        logger.info(
+                            "❌ Snippet {} file {} has changed.".format(name, f)
+                        )
+                        if print_diff:
+                            self._print_diff(
+                                os.path.join(snippet_path, f),
+                                os.path.join(tmp_path, f),
+                                diff_limit,
+                            )
+                    elif status == FileStatus.ADDED:
+                        logger.info(
+                            "❌ Snippet {} file {} is not present.".format(name, f)
+                        )
                     else:
-                        print(line, file=sys.stderr)
+                        logger.info(
+                            "❌ Snippet {} file {} is not present in the source.".format(
+                                name, f
+                            )
+                        )
+                return SnippetStatus.CHANGED, tuple(files), None
 
-    def _check_package(self, name: str, print_diff: bool = False) -> int:
-        try:
+            return SnippetStatus.UP_TO_DATE, tuple(files), None
 
-            if name not in self.config():
-                logger.warning("❌ Snippet {} is not installed.".format(name))
-                return 1
+        elif os.path.isfile(tmp_path) and os.path.isfile(snippet_path):
+            # Compare two files
 
-            url = self.config()[name]
+            comparison = compare_files(snippet_path, tmp_path)
 
-            downloader_class = self._dispatch_url(url)
+            if not comparison.same:
+                if comparison.offset is None:
+                    logger.warning(
+                        "❌ Snippet {} has changed (size {} bytes, source {} bytes).".format(
+                            name, comparison.local_size, comparison.source_size
+                        )
+                    )
+                else:
+                    logger.warning(
+                        "❌ Snippet {} has changed (first difference at byte {}).".format(
+                            name, comparison.offset
+                        )
+                    )
+                if print_diff:
+                    self._print_diff(snippet_path, tmp_path, diff_limit)
+                return SnippetStatus.CHANGED, (), comparison.offset
 
-            try:
-                tmp_path = downloader_class.download(url=url)
-            except DownloaderError as e:
-                logger.error(
-                    "Error: Snippet {} cannot be checked - {}.".format(name, str(e))
-                )
-                raise SniptyCriticalError(1)
+            return SnippetStatus.UP_TO_DATE, (), None
 
-            snippet_path = os.path.join(self.project_root, name)
+        # Mismatch of types file-dir
+        logger.warning(
+            "❌ Snippet {} has changed between single and multi file.".format(name)
+        )
+        return SnippetStatus.CHANGED, (), None
+
+    def _check_package(
+        self,
+        name: str,
+        print_diff: bool = False,
+        diff_limit: int = DEFAULT_DIFF_LIMIT,
+        hashes: bool = False,
+        local_digest: str = None,
+    ) -> CheckResult:
+        started = time.monotonic()
 
-            if os.path.isdir(tmp_path) and os.path.isdir(snippet_path):
-                # Compare two directories
+        try:
+            url = self.config().get(name)
+        except ConfigNotExists:
+            logger.error(
+                "Error: Snipty was not used before in this project root path: {}".format(
+                    self.project_root
+                )
+            )
+            raise SniptyCriticalError(1)
 
-                files_changed_sum = 0
+        if url is None:
+            logger.warning("❌ Snippet {} is not installed.".format(name))
+            return CheckResult(name, url, SnippetStatus.NOT_TRACKED)
 
-                result = filecmp.dircmp(snippet_path, tmp_path)
+        try:
+            tmp_path = self._download(url)
+        except DownloaderError as e:
+            logger.error(
+                "Error: Snippet {} cannot be checked - {}.".format(name, str(e))
+            )
+            return CheckResult(
+                name,
+                url,
+                SnippetStatus.ERROR,
+                duration=time.monotonic() - started,
+                error=str(e),
+            )
 
-                if result.diff_files or result.right_only:
+        try:
+            status, files, offset = self._compare_package(
+                name, tmp_path, print_diff, diff_limit
+            )
+            if status == SnippetStatus.UP_TO_DATE:
+                logger.info("✔ Snippet {} present and up to date.".format(name))
+
+            local_hash = upstream_hash = None
+            if hashes:
+                local_hash = local_digest or self._package_checksum(name)
+                # Comparison already proved contents equal, upstream copy has the same hash
+                upstream_hash = (
+                    local_hash
+                    if status == SnippetStatus.UP_TO_DATE
+                    else self._path_checksum(tmp_path)
+                )
 
-                    files_of_interest = (
-                        result.same_files + result.diff_files + result.right_only
-                    )
-                    files_of_interest.sort()
+            return CheckResult(
+                name,
+                url,
+                status,
+                files=files,
+                local_hash=local_hash,
+                upstream_hash=upstream_hash,
+                duration=time.monotonic() - started,
+                first_difference=offset,
+            )
+        finally:
+            remove_path(tmp_path)
 
-                    for f in files_of_interest:
-                        if f in result.same_files:
-                            logger.info(
-                                "✔ Snippet {} file {} did not changed.".format(name, f)
-                            )
-                        elif f in result.diff_files:
-                            logger.info(
-                                "❌ Snippet {} file {} has changed.".format(name, f)
-                            )
-                            files_changed_sum += 1
-                            if print_diff:
-                                self._print_diff(
-                                    os.path.join(snippet_path, f),
-                                    os.path.join(tmp_path, f),
-                                )
-                        elif f in result.right_only:
-                            files_changed_sum += 1
-                            logger.info(
-                                "❌ Snippet {} file {} is not present.".format(name, f)
-                            )
-                if files_changed_sum > 0:
-                    return 1
+    def _probe_upstream(self, names, state: SniptyState, refresh: bool) -> dict:
+        """
+        Ask downloaders for cheap upstream validators of many snippets at once.
 
-            elif os.path.isfile(tmp_path) and os.path.isfile(snippet_path):
-                # Compare two files
+        Returns map of url to validator as returned by `BaseDownloader.probe`. Every url is limited to
+        changes after its last verification when its validator is known (and `refresh` is not set).
+        """
+        urls_by_downloader = {}
+        since = {}
 
-                if not filecmp.cmp(snippet_path, tmp_path, shallow=False):
-                    logger.warning("❌ Snippet {} has changed.".format(name))
-                    if print_diff:
-                        self._print_diff(snippet_path, tmp_path)
-                    return 1
-            else:
-                # Mismatch of types file-dir
-                logger.warning(
-                    "❌ Snippet {} has changed between single and multi file.".format(
-                        name
+        for name in names:
+            url = self.config().get(name)
+            if url is None:
+                continue
+            downloader_class = self._dispatch_url(url)
+            if downloader_class.probe.__func__ is BaseDownloader.probe.__func__:
+                # Downloader cannot probe, there is no point in collecting its urls
+                continue
+            urls_by_downloader.setdefault(downloader_class, []).append(url)
+
+            entry = state.get(name)
+            if not refresh and entry is not None and entry.get("validator") is not None:
+                since[url] = entry["verified_at"] - PROBE_CLOCK_SKEW
+
+        validators = {}
+        with recording(self.metrics):
+            for downloader_class, urls in urls_by_downloader.items():
+                validators.update(
+                    downloader_class.probe(
+                        urls, since={url: since[url] for url in urls if url in since}
                     )
                 )
-                return 1
-
-            logger.info("✔ Snippet {} present and up to date.".format(name))
-            return 0
 
-        except ConfigNotExists:
-            logger.error(
-                "Error: Snipty was not used before in this project root path: {}".format(
-                    self.project_root
+        return validators
+
+    def _current_validator(self, url: str, entry, validators: dict):
+        """Upstream validator of snippet after probing (None when unknown)"""
+        validator = validators.get(url)
+        if validator is NOT_MODIFIED:
+            # Not modified since last verification
+            return entry.get("validator") if entry is not None else None
+        return validator
+
+    def _check_package_incremental(
+        self,
+        name: str,
+        state: SniptyState,
+        local_digest: str,
+        validators: dict,
+        verified_at: float,
+        refresh: bool,
+        **kwargs
+    ) -> CheckResult:
+        """Check package unless upstream validator proves it was not modified"""
+
+        entry = state.get(name)
+        validator = self._current_validator(self.config().get(name), entry, validators)
+
+        if (
+            not refresh
+            and entry is not None
+            and entry["local_digest"] == local_digest
+            and validator is not None
+            and validator == entry.get("validator")
+        ):
+            logger.info(
+                "✔ Snippet {} present and up to date (not modified upstream).".format(
+                    name
                 )
             )
-            raise SniptyCriticalError(1)
+            state.record(
+                name,
+                local_digest=local_digest,
+                validator=validator,
+                verified_at=verified_at,
+            )
+            return self._cached_result(name, local_digest)
+
+        result = self._check_package(name=name, local_digest=local_digest, **kwargs)
+
+        if result.up_to_date:
+            state.record(
+                name,
+                local_digest=local_digest,
+                validator=validator,
+                verified_at=verified_at,
+            )
+        else:
+            state.forget(name)
+
+        return result
+
+    def _cached_result(self, name: str, local_digest: str) -> CheckResult:
+        return CheckResult(
+            name,
+            self.config().get(name),
+            SnippetStatus.UP_TO_DATE,
+            local_hash=local_digest,
+            upstream_hash=local_digest,
+            cached=True,
+        )
+
+    def _check_packages(self, names, incremental, max_age, refresh, **kwargs) -> list:
+        if not (incremental or refresh):
+            return [self._check_package(name=name, **kwargs) for name in names]
+
+        state = SniptyState(self.state_file_path)
+        try:
+            results = {}
+            local_digests = {}
+            pending = []
+            for name in names:
+                local_digests[name] = self._package_checksum(name)
+                if not refresh and state.is_fresh(name, local_digests[name], max_age):
+                    logger.info(
+                        "✔ Snippet {} present and up to date (cached).".format(name)
+                    )
+                    results[name] = self._cached_result(name, local_digests[name])
+                else:
+                    pending.append(name)
+
+            # Taken before asking upstream so changes made meanwhile are not missed next time
+            verified_at = time.time()
+            validators = self._probe_upstream(pending, state, refresh)
+
+            for name in pending:
+                results[name] = self._check_package_incremental(
+                    name,
+                    state,
+                    local_digest=local_digests[name],
+                    validators=validators,
+                    verified_at=verified_at,
+                    refresh=refresh,
+                    **kwargs
+                )
+
+            return [results[name] for name in names]
+        finally:
+            state.save()
 
     @ensure_config_exists
-    def check(self, name: str, print_diff=False):
-        """Check for single package"""
+    @within_run
+    def verify(
+        self,
+        names=None,
+        print_diff=False,
+        incremental=False,
+        max_age=DEFAULT_MAX_AGE,
+        refresh=False,
+        diff_limit=DEFAULT_DIFF_LIMIT,
+        hashes=True,
+    ) -> List[CheckResult]:
+        """
+        Check snippets (all tracked ones by default) and return result for every one of them.
 
-        return self._check_package(name=name, print_diff=print_diff)
+        Unlike `check` problems with a single snippet (e.g. download errors) are reported in its result and
+        do not stop checking remaining ones. With `incremental` snippet verified less than `max_age` seconds
+        ago (and not changed locally since) is not checked again; `refresh` forces verification but still
+        records its result. Diffs are printed only for text files not larger than `diff_limit` bytes.
+        Local and upstream hashes of results are computed only with `hashes`.
+        """
 
-    def check_all(self, print_diff=False):
-        """Will return exit status equal to number of differences found"""
+        results = self._check_packages(
+            list(self.config()) if names is None else list(names),
+            incremental=incremental,
+            max_age=max_age,
+            refresh=refresh,
+            print_diff=print_diff,
+            diff_limit=diff_limit,
+            hashes=hashes,
+        )
+
+        for result in results:
+            self.metrics.inc("snipty_snippets_checked_total", status=result.status)
+            if result.url is not None and not os.path.exists(
+                self._get_package_full_path(result.name)
+            ):
+                self.metrics.inc("snipty_snippets_missing_total")
+        return results
 
-        exit_status = 0
-        for name in self.config():
-            exit_status += self._check_package(name=name, print_diff=print_diff)
+    def _exit_status(self, results) -> int:
+        if any(result.status == SnippetStatus.ERROR for result in results):
+            raise SniptyCriticalError(1)
+        return sum(1 for result in results if not result.up_to_date)
+
+    def check(
+        self,
+        name: str,
+        print_diff=False,
+        incremental=False,
+        max_age=DEFAULT_MAX_AGE,
+        refresh=False,
+        diff_limit=DEFAULT_DIFF_LIMIT,
+    ):
+        """Check for single package"""
 
-        return exit_status
+        return self._exit_status(
+            self.verify(
+                [name],
+                print_diff=print_diff,
+                incremental=incremental,
+                max_age=max_age,
+                refresh=refresh,
+                diff_limit=diff_limit,
+                hashes=False,
+            )
+        )
+
+    def check_all(
+        self,
+        print_diff=False,
+        incremental=False,
+        max_age=DEFAULT_MAX_AGE,
+        refresh=False,
+        diff_limit=DEFAULT_DIFF_LIMIT,
+        names=None,
+    ):
+        """Will return exit status equal to number of differences found (`names` limits checked snippets)"""
+
+        return self._exit_status(
+            self.verify(
+                names,
+                print_diff=print_diff,
+                incremental=incremental,
+                max_age=max_age,
+                refresh=refresh,
+                diff_limit=diff_limit,
+                hashes=False,
+            )
+        )
 
     # Config helpers
 
@@ -378,31 +993,50 @@ class Snipty:
     def config_file_path(self):
         return os.path.join(self.project_root, "snipty.yml")
 
+    @property
+    def state_file_path(self):
+        return os.path.join(self.project_root, STATE_FILE_NAME)
+
+    def _config_file_signature(self):
+        try:
+            stat = os.stat(self.config_file_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
     def config(self, create: bool = False) -> dict:
-        """Loads, checks and cache snipty config file"""
+        """Loads, checks and cache snipty config file (re-read when the file changes on disk)"""
+
+        with self._config_lock:
+            signature = self._config_file_signature()
 
-        if self._config is None:
-            # If there is no cached config file yet then read it
-            if not os.path.exists(self.config_file_path):
+            if signature is None:
                 if not create:
                     # Some commands should not run in directories where snipty config was not present
                     raise ConfigNotExists
                 # Initiate empty config otherwise
                 self._store_config({})
+                signature = self._config_file_signature()
+                self._config = None
 
-            # Read (or re-read) snipty config file
-            with open(self.config_file_path, "r") as f:
-                self._config = yaml.load(f)
+            if self._config is None or signature != self._config_signature:
+                # Read (or re-read) snipty config file
+                with open(self.config_file_path, "r") as f:
+                    self._config = yaml.safe_load(f) or {}
+                self._config_signature = signature
 
-        return self._config
+            return self._config
 
     def _store_config(self, data):
-        with open(self.config_file_path, "w") as f:
-            yaml.dump(data, f, default_flow_style=False)
+        with self._config_lock:
+            with open(self.config_file_path, "w") as f:
+                yaml.dump(data, f, default_flow_style=False)
+            self._config_signature = self._config_file_signature()
 
     def store_config(self):
-        try:
-            config = self.config()
-            self._store_config(config)
-        except ConfigNotExists:
-            pass
+        with self._config_lock:
+            try:
+                config = self.config()
+                self._store_config(config)
+            except ConfigNotExists:
+                pass
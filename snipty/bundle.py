@@ -0,0 +1,169 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+
+from snipty.compare import tree_files
+
+BUNDLE_VERSION = 1
+MANIFEST_NAME = "snipty-bundle.json"
+SNIPPETS_DIR = "snippets"
+
+KIND_FILE = "file"
+KIND_DIR = "dir"
+
+
+class BundleError(Exception):
+    pass
+
+
+def _file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _arcname(name: str, kind: str, relative_path: str = None) -> str:
+    if kind == KIND_FILE:
+        return "/".join((SNIPPETS_DIR, name))
+    return "/".join((SNIPPETS_DIR, name, relative_path))
+
+
+def create_bundle(out_path: str, project_root: str, snippets: dict):
+    """
+    Pack installed snippets into a single gzipped tar archive.
+
+    `snippets` maps snippet name to its url. Manifest with urls and sha256 of every file is stored as the
+    first archive member, so the bundle can be restored with one sequential read.
+    """
+    manifest = {"version": BUNDLE_VERSION, "snippets": {}}
+    members = []
+
+    for name in sorted(snippets):
+        snippet_path = os.path.join(project_root, name)
+        if os.path.isdir(snippet_path):
+            files = tree_files(snippet_path)
+            kind = KIND_DIR
+        else:
+            files = {"": snippet_path}
+            kind = KIND_FILE
+
+        manifest["snippets"][name] = {
+            "url": snippets[name],
+            "kind": kind,
+            "files": {
+                relative_path: _file_digest(full_path)
+                for relative_path, full_path in files.items()
+            },
+        }
+        for relative_path, full_path in files.items():
+            members.append((_arcname(name, kind, relative_path), full_path))
+
+    manifest_data = json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8")
+
+    with tarfile.open(out_path, "w:gz") as archive:
+        manifest_info = tarfile.TarInfo(MANIFEST_NAME)
+        manifest_info.size = len(manifest_data)
+        archive.addfile(manifest_info, io.BytesIO(manifest_data))
+
+        for arcname, full_path in members:
+            archive.add(full_path, arcname=arcname, recursive=False)
+
+
+def restore_bundle(bundle_path: str, staging_directory: str, names=None) -> dict:
+    """
+    Extract snippets from a bundle into `staging_directory` verifying their hashes.
+
+    Returns a map of snippet name to `(url, tmp_path)` where `tmp_path` is a file or directory exactly like
+    returned by `BaseDownloader.download`. When `names` is given only those snippets are extracted.
+    """
+    restored = {}
+
+    try:
+        with tarfile.open(bundle_path, "r|gz") as archive:
+            manifest = _read_manifest(archive, bundle_path)
+            snippets = manifest["snippets"]
+
+            selected = sorted(snippets) if names is None else sorted(set(names))
+            missing = [name for name in selected if name not in snippets]
+            if missing:
+                raise BundleError(
+                    "snippets {} are not present in bundle".format(", ".join(missing))
+                )
+
+            expected = {}
+            for index, name in enumerate(selected):
+                kind = snippets[name]["kind"]
+                tmp_path = os.path.join(staging_directory, str(index))
+                if kind == KIND_DIR:
+                    os.mkdir(tmp_path)
+                restored[name] = (snippets[name]["url"], tmp_path)
+
+                for relative_path, digest in snippets[name]["files"].items():
+                    parts = relative_path.split("/")
+                    if kind == KIND_DIR and ("" in parts or ".." in parts):
+                        raise BundleError(
+                            "invalid file path {} in bundle".format(relative_path)
+                        )
+                    destination = (
+                        tmp_path
+                        if kind == KIND_FILE
+                        else os.path.join(tmp_path, *parts)
+                    )
+                    expected[_arcname(name, kind, relative_path)] = (
+                        name,
+                        destination,
+                        digest,
+                    )
+
+            for member in archive:
+                if member.name not in expected:
+                    continue
+                if not member.isfile():
+                    raise BundleError("invalid bundle entry {}".format(member.name))
+
+                name, destination, digest = expected.pop(member.name)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+                h = hashlib.sha256()
+                with archive.extractfile(member) as source, open(
+                    destination, "wb"
+                ) as destination_file:
+                    for chunk in iter(lambda: source.read(1024 * 1024), b""):
+                        h.update(chunk)
+                        destination_file.write(chunk)
+
+                if h.hexdigest() != digest:
+                    raise BundleError(
+                        "snippet {} file {} does not match its hash".format(
+                            name, member.name
+                        )
+                    )
+
+            if expected:
+                raise BundleError(
+                    "bundle is missing files: {}".format(", ".join(sorted(expected)))
+                )
+
+    except (tarfile.TarError, OSError, ValueError, KeyError) as e:
+        raise BundleError("cannot read bundle {} ({})".format(bundle_path, e))
+
+    return restored
+
+
+def _read_manifest(archive: tarfile.TarFile, bundle_path: str) -> dict:
+    member = archive.next()
+    if member is None or member.name != MANIFEST_NAME:
+        raise BundleError("{} is not a snipty bundle".format(bundle_path))
+
+    with archive.extractfile(member) as f:
+        manifest = json.loads(f.read().decode("utf-8"))
+
+    if manifest.get("version") != BUNDLE_VERSION:
+        raise BundleError(
+            "unsupported bundle version {}".format(manifest.get("version"))
+        )
+    return manifest
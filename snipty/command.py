@@ -2,8 +2,29 @@ import argparse
 import os
 import logging
 import sys
+import time
 
-from snipty.base import Snipty, SniptyCriticalError
+from snipty.base import (
+    DEFAULT_DIFF_LIMIT,
+    DEFAULT_MAX_AGE,
+    Snipty,
+    SniptyCriticalError,
+)
+from snipty.downloaders import (
+    DownloadPolicy,
+    GitDownloader,
+    SingleFlight,
+    parse_size,
+)
+from snipty.metrics import Metrics
+from snipty.mirror import (
+    DEFAULT_ALLOWED_HOSTS,
+    DEFAULT_ALLOWED_SCHEMES,
+    MirrorServer,
+)
+from snipty.monorepo import discover_roots, run_recursive
+from snipty.sharding import load_timings, parse_shard, shard_names
+from snipty.state import STATE_FILE_NAME
 from . import __VERSION__
 
 parser = argparse.ArgumentParser(
@@ -33,6 +54,72 @@ parser.add_argument(
     help="Project root path; default: SNIPTY_ROOT_PATH environment variable or current directory",
 )
 
+parser.add_argument(
+    "-r",
+    "--recursive",
+    action="store_true",
+    help="Run check, list or install for every snipty.yml found below project root path",
+)
+
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive number".format(value))
+    return number
+
+
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=positive_int,
+    metavar="<workers>",
+    help="Number of concurrent workers hashing files in list and processing project roots "
+    "in recursive mode; default: serial hashing, CPU count based number of roots",
+)
+
+parser.add_argument(
+    "--metrics-file",
+    metavar="<metrics path>",
+    help="Write run metrics in Prometheus text format (e.g. for node_exporter textfile collector)",
+)
+
+
+def size_type(value):
+    try:
+        return parse_size(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+parser.add_argument(
+    "--max-snippet-bytes",
+    type=size_type,
+    default=argparse.SUPPRESS,
+    metavar="<size>",
+    help="Abort download of a snippet larger than given size (e.g. 512K, 10M, 0 for no limit); "
+    "default: SNIPTY_MAX_SNIPPET_BYTES environment variable or 10M",
+)
+
+parser.add_argument(
+    "--max-run-bytes",
+    type=size_type,
+    default=argparse.SUPPRESS,
+    metavar="<size>",
+    help="Abort downloads when all snippets of the run exceed given size; "
+    "default: SNIPTY_MAX_RUN_BYTES environment variable or no limit",
+)
+
+parser.add_argument(
+    "--sniff-content",
+    action="store_true",
+    default=argparse.SUPPRESS,
+    help="Accept snippets served without text content type when their first bytes look like a text",
+)
+
 subparsers = parser.add_subparsers(title="Commands", dest="command")
 
 parser_untrack = subparsers.add_parser(
@@ -55,6 +142,39 @@ parser_check.add_argument(
     "-d", "--diff", action="store_true", help="Display diff results"
 )
 
+parser_check.add_argument(
+    "--diff-limit",
+    type=size_type,
+    default=DEFAULT_DIFF_LIMIT,
+    metavar="<size>",
+    help="Display diff only of text files not larger than given size (0 for no limit); default: 1M",
+)
+
+parser_check.add_argument(
+    "-i",
+    "--incremental",
+    action="store_true",
+    help="Skip snippets verified recently that did not change locally (uses {} file)".format(
+        STATE_FILE_NAME
+    ),
+)
+
+parser_check.add_argument(
+    "--max-age",
+    type=float,
+    default=DEFAULT_MAX_AGE,
+    metavar="<seconds>",
+    help="Verify again snippets checked more than given seconds ago; default: {}".format(
+        DEFAULT_MAX_AGE
+    ),
+)
+
+parser_check.add_argument(
+    "--refresh",
+    action="store_true",
+    help="Verify all snippets and store results for following incremental checks",
+)
+
 parser_check.add_argument(
     "snippet_name",
     nargs="?",
@@ -64,6 +184,49 @@ parser_check.add_argument(
 
 parser_list = subparsers.add_parser("list", help="Freeze installed snippets")
 
+
+def add_changed_paths_arguments(subparser):
+    group = subparser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--staged",
+        action="store_true",
+        help="Process only snippets affected by files staged for commit in git",
+    )
+    group.add_argument(
+        "--paths",
+        nargs="+",
+        metavar="<path>",
+        help="Process only snippets affected by given changed paths (relative to project root)",
+    )
+
+
+add_changed_paths_arguments(parser_check)
+add_changed_paths_arguments(parser_list)
+
+
+def shard_type(value):
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def add_shard_arguments(subparser):
+    subparser.add_argument(
+        "--shard",
+        type=shard_type,
+        metavar="<index>/<total>",
+        help="Process only deterministic part of snippets, e.g. 1/4 (for parallel CI nodes)",
+    )
+    subparser.add_argument(
+        "--shard-timings",
+        metavar="<timings file>",
+        help='JSON file {"snippet name": seconds} used to balance shards by durations',
+    )
+
+
+add_shard_arguments(parser_check)
+
 parser_install = subparsers.add_parser("install", help="Install snippets")
 
 parser_install.add_argument(
@@ -84,6 +247,66 @@ parser_install.add_argument(
     "snippet_url", nargs="?", help="snippets url", metavar="<snippets url>"
 )
 
+parser_install.add_argument(
+    "--from-bundle",
+    metavar="<bundle path>",
+    help="Restore missing snippets from a bundle instead of downloading them",
+)
+
+parser_install.add_argument(
+    "--only",
+    action="append",
+    metavar="<snippets name>",
+    help="Install only given snippet (can be used multiple times)",
+)
+
+parser_bundle = subparsers.add_parser(
+    "bundle", help="Pack installed snippets into a single archive for offline installs"
+)
+parser_bundle.add_argument("out", metavar="<bundle path>", help="output archive path")
+
+parser_serve = subparsers.add_parser(
+    "serve", help="Run caching mirror of snippets (clients use SNIPTY_MIRROR variable)"
+)
+
+parser_serve.add_argument(
+    "--host", default="127.0.0.1", help="Interface to listen on; default: 127.0.0.1"
+)
+
+parser_serve.add_argument(
+    "--port", type=int, default=8765, help="Port to listen on; default: 8765"
+)
+
+parser_serve.add_argument(
+    "--ttl",
+    type=float,
+    default=300,
+    help="Seconds after which cached snippet is revalidated with origin; default: 300",
+)
+
+parser_serve.add_argument(
+    "--allow-host",
+    action="append",
+    metavar="<host>",
+    help="Host whose snippets can be mirrored (can be used multiple times); default: {}".format(
+        ", ".join(DEFAULT_ALLOWED_HOSTS)
+    ),
+)
+
+parser_serve.add_argument(
+    "--allow-http",
+    action="store_true",
+    help="Mirror also plain http urls of allowed hosts",
+)
+
+parser_serve.add_argument(
+    "--allow-git",
+    action="store_true",
+    help="Mirror also git+https and git+ssh repositories of allowed hosts",
+)
+
+add_shard_arguments(parser_install)
+
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 logger = logging.getLogger("snipty")
 logger.setLevel(logging.INFO)
@@ -92,10 +315,55 @@ logger.setLevel(logging.INFO)
 class SniptyCommand:
     def __init__(self, args):
         self.args = args
-        self.snipty = Snipty(project_root=self.args.path)
+        # Every snippet is downloaded at most once during a single command run
+        self.downloads = SingleFlight()
+        self.metrics = Metrics()
+        try:
+            self.policy = DownloadPolicy.from_environment(**self._policy_options(args))
+        except ValueError as e:
+            logger.error("Error: Invalid download limit: {}.".format(e))
+            raise SniptyCriticalError(1)
+        self.snipty = Snipty(
+            project_root=self.args.path,
+            downloads=self.downloads,
+            metrics=self.metrics,
+            policy=self.policy,
+        )
+
+    @staticmethod
+    def _policy_options(args):
+        """Download limits given on command line (override environment variables)"""
+        return {
+            option: getattr(args, option)
+            for option in ("max_snippet_bytes", "max_run_bytes", "sniff_content")
+            if hasattr(args, option)
+        }
+
+    RECURSIVE_COMMANDS = ("check", "list", "install")
 
     def dispatch(self):
-        getattr(self, self.args.command)(self.args)
+        """Runs command; returns its exit status"""
+        started = time.monotonic()
+        try:
+            with self.downloads:
+                if self.args.recursive:
+                    return getattr(self, "recursive_" + self.args.command)(self.args)
+                return getattr(self, self.args.command)(self.args)
+        finally:
+            self.metrics.set(
+                "snipty_run_duration_seconds",
+                time.monotonic() - started,
+                command=self.args.command,
+            )
+            self._write_metrics()
+
+    def _write_metrics(self):
+        if not self.args.metrics_file:
+            return
+        try:
+            self.metrics.write(self.args.metrics_file)
+        except OSError as e:
+            logger.error("Error: Cannot write metrics file - {}.".format(str(e)))
 
     def install(self, args):
         """Calls snipty logic depending on arguments"""
@@ -104,12 +372,54 @@ class SniptyCommand:
                 name=args.snippet_name, url=args.snippet_url, force=args.force
             )
         else:
-            self.snipty.install_missing(force=args.force)
+            self.snipty.install_missing(
+                force=args.force,
+                bundle=args.from_bundle,
+                names=self._sharded(args, args.only),
+            )
+
+    def _sharded(self, args, names):
+        """Limit `names` (all tracked snippets when None) to the --shard part"""
+        if args.shard is None:
+            return names
+
+        timings = None
+        if args.shard_timings:
+            try:
+                timings = load_timings(args.shard_timings)
+            except (OSError, ValueError) as e:
+                logger.error("Error: Cannot read shard timings - {}.".format(str(e)))
+                raise SniptyCriticalError(1)
+
+        if names is None:
+            names = self.snipty.tracked_snippets()
+
+        index, total = args.shard
+        selected = shard_names(names, index, total, timings=timings)
+        logger.info(
+            "Shard {}/{}: {} of {} snippets.".format(
+                index, total, len(selected), len(names)
+            )
+        )
+        return selected
+
+    def _changed_snippets(self, args):
+        """Snippets affected by --staged or --paths (None when not limited)"""
+        if args.staged:
+            return self.snipty.staged_snippets()
+        if args.paths:
+            return self.snipty.affected_snippets(args.paths)
+        return None
 
     def list(self, args):
         """Calls snipty logic for freeze"""
-        list_result = self.snipty.list()
+        names = self._changed_snippets(args)
+        if names == []:
+            return
+
+        self._print_list(self.snipty.list(workers=args.jobs or 1, names=names))
 
+    def _print_list(self, list_result):
         for package, checksum, url in list_result["installed"]:
             print(package, checksum, url, sep="\t")
 
@@ -121,6 +431,10 @@ class SniptyCommand:
             for package, url in list_result["not_installed"]:
                 print(package, url, sep="\t")
 
+    def bundle(self, args):
+        """Calls snipty logic for bundle"""
+        self.snipty.bundle(out_path=args.out)
+
     def untrack(self, args):
         """Calls snipty logic for untrack"""
         self.snipty.untrack(name=args.snippet_name)
@@ -132,11 +446,151 @@ class SniptyCommand:
     def check(self, args):
         """Calls snipty logic for check"""
         if args.snippet_name:
-            exit = self.snipty.check(name=args.snippet_name, print_diff=args.diff)
-        else:
-            exit = self.snipty.check_all(print_diff=args.diff)
+            return self.snipty.check(
+                name=args.snippet_name, **self._check_options(args)
+            )
 
-        sys.exit(exit)
+        names = self._changed_snippets(args)
+        if names == []:
+            logger.info("✔ No snippets affected by changed files.")
+            return 0
+
+        names = self._sharded(args, names)
+        if names == []:
+            return 0
+
+        return self.snipty.check_all(names=names, **self._check_options(args))
+
+    def _check_options(self, args):
+        return dict(
+            print_diff=args.diff,
+            diff_limit=args.diff_limit,
+            incremental=args.incremental,
+            max_age=args.max_age,
+            refresh=args.refresh,
+        )
+
+    # Recursive (monorepo) mode
+
+    def _run_recursive(self, action):
+        roots = discover_roots(self.args.path)
+        if not roots:
+            logger.error("Error: No snipty.yml found below {}".format(self.args.path))
+            raise SniptyCriticalError(1)
+
+        return run_recursive(
+            roots,
+            action,
+            snipty_class=type(self.snipty),
+            workers=self.args.jobs,
+            downloads=self.downloads,
+            metrics=self.metrics,
+            policy=self.policy,
+            label=self._root_name,
+        )
+
+    def _root_name(self, root):
+        return os.path.relpath(root, self.args.path)
+
+    def recursive_check(self, args):
+        """Calls snipty check logic for every project root"""
+        results = self._run_recursive(
+            lambda snipty: (snipty.check_all(**self._check_options(args)), None)
+        )
+
+        changed = 0
+        for result in results:
+            if result.failed:
+                continue
+            if result.exit_code:
+                logger.warning(
+                    "❌ {}: {} snippets changed.".format(
+                        self._root_name(result.root), result.exit_code
+                    )
+                )
+            else:
+                logger.info(
+                    "✔ {}: all snippets up to date.".format(
+                        self._root_name(result.root)
+                    )
+                )
+            changed += result.exit_code
+
+        logger.info(
+            "Checked {} project roots, {} snippets changed.".format(
+                len(results), changed
+            )
+        )
+        self._exit_recursive(results)
+        return changed
+
+    def recursive_list(self, args):
+        """Calls snipty list logic for every project root"""
+        results = self._run_recursive(
+            lambda snipty: (0, snipty.list(workers=args.jobs or 1))
+        )
+
+        for result in results:
+            print("# {}".format(self._root_name(result.root)))
+            if result.value is not None:
+                self._print_list(result.value)
+            print()
+
+        self._exit_recursive(results)
+
+    def recursive_install(self, args):
+        """Calls snipty install logic for every project root"""
+
+        def install(snipty):
+            snipty.install_missing(force=args.force)
+            return 0, None
+
+        self._exit_recursive(self._run_recursive(install))
+
+    def _exit_recursive(self, results):
+        failed = [result for result in results if result.failed]
+        for result in failed:
+            logger.error(
+                "Error: {} failed with exit status {}.".format(
+                    self._root_name(result.root), result.exit_code
+                )
+            )
+        if failed:
+            raise SniptyCriticalError(max(result.exit_code for result in failed))
+
+    def serve(self, args):
+        """Runs snippets mirror until interrupted"""
+        schemes = list(DEFAULT_ALLOWED_SCHEMES)
+        if args.allow_http:
+            schemes.append("http")
+        downloaders = [
+            downloader
+            for downloader in self.snipty.SUPPORTED_DOWNLOADERS
+            if args.allow_git or downloader is not GitDownloader
+        ]
+        if args.allow_git:
+            # Never local repositories (git+file) of the mirror host
+            schemes += ["git+https", "git+ssh"]
+
+        server = MirrorServer(
+            (args.host, args.port),
+            downloaders=downloaders,
+            ttl=args.ttl,
+            allowed_hosts=args.allow_host or DEFAULT_ALLOWED_HOSTS,
+            allowed_schemes=schemes,
+            policy=self.policy,
+        )
+        logger.info(
+            "Serving snippets mirror on http://{}:{}/".format(
+                *server.server_address[:2]
+            )
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
 
 
 if __name__ == "__main__":
@@ -146,6 +600,27 @@ if __name__ == "__main__":
         parser.print_help(sys.stderr)
         sys.exit(1)
 
+    if args.recursive and (
+        args.command not in SniptyCommand.RECURSIVE_COMMANDS
+        or getattr(args, "snippet_name", None)
+        or getattr(args, "from_bundle", None)
+        or getattr(args, "staged", False)
+        or getattr(args, "paths", None)
+        or getattr(args, "shard", None)
+        or getattr(args, "only", None)
+    ):
+        parser.error(
+            "--recursive works only with check, list and install of all snippets"
+        )
+
+    if getattr(args, "snippet_name", None) and (
+        getattr(args, "staged", False) or getattr(args, "paths", None)
+    ):
+        parser.error("--staged and --paths cannot be used with snippet name")
+
+    if getattr(args, "snippet_name", None) and getattr(args, "shard", None):
+        parser.error("--shard cannot be used with snippet name")
+
     if args.quiet == 1:
         logger.setLevel(logging.WARNING)
 
@@ -156,6 +631,6 @@ if __name__ == "__main__":
         logger.setLevel(logging.CRITICAL)
 
     try:
-        SniptyCommand(args).dispatch()
+        sys.exit(SniptyCommand(args).dispatch())
     except SniptyCriticalError as e:
         sys.exit(e.code)
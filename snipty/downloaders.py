@@ -1,10 +1,22 @@
+import hashlib
+import io
+import json
 import logging
 import os
+import shutil
+import tarfile
 import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Union
 from urllib.parse import urlparse
 
 import requests
 
+from snipty.git import GitError, run_git
+from snipty.metrics import record_http_response
+
 logger = logging.getLogger("snipty")
 
 
@@ -12,6 +24,264 @@ class DownloaderError(Exception):
     pass
 
 
+# Validator returned by `BaseDownloader.probe` for urls that did not change since given time
+NOT_MODIFIED = "not-modified"
+
+
+def remove_path(path: str):
+    """Remove temporary file or directory returned by `BaseDownloader.download`"""
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def copy_download(path: str) -> str:
+    """Copy downloaded snippet to a new temporary location (callers are free to move it)"""
+    if os.path.isdir(path):
+        destination_directory = tempfile.mkdtemp(dir=os.environ.get("SNIPTY_TMP"))
+        for file_name in os.listdir(path):
+            source = os.path.join(path, file_name)
+            if os.path.isdir(source):
+                shutil.copytree(source, os.path.join(destination_directory, file_name))
+            else:
+                shutil.copy(source, destination_directory)
+        return destination_directory
+
+    with tempfile.NamedTemporaryFile(
+        delete=False, dir=os.environ.get("SNIPTY_TMP")
+    ) as destination_file, open(path, "rb") as source_file:
+        shutil.copyfileobj(source_file, destination_file)
+        return destination_file.name
+
+
+DEFAULT_MAX_SNIPPET_BYTES = 10 * 1024 * 1024
+
+SIZE_SUFFIXES = {"K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parse_size(value: str) -> Union[int, None]:
+    """Parse byte size like `512`, `64K` or `10M`; zero means unlimited (None)"""
+    value = str(value).strip().upper()
+    multiplier = SIZE_SUFFIXES.get(value[-1:], 1)
+    if value[-1:] in SIZE_SUFFIXES:
+        value = value[:-1]
+    try:
+        size = int(value) * multiplier
+    except ValueError:
+        raise ValueError("invalid size {}".format(value))
+    if size < 0:
+        raise ValueError("size cannot be negative")
+    return size or None
+
+
+def _environment_size(name: str, default) -> Union[int, None]:
+    try:
+        return parse_size(os.environ.get(name, default))
+    except ValueError as e:
+        raise ValueError("{} - {}".format(name, e))
+
+
+class DownloadPolicy:
+    """
+    Limits of downloaded data: bytes of a single snippet, bytes of the whole run (shared by all
+    downloads made under this policy during one run, see `SingleFlight`) and whether text bodies
+    without accepted content type are allowed after inspecting their first chunk.
+    """
+
+    def __init__(
+        self,
+        max_snippet_bytes: int = DEFAULT_MAX_SNIPPET_BYTES,
+        max_run_bytes: int = None,
+        sniff_content: bool = False,
+    ):
+        self.max_snippet_bytes = max_snippet_bytes
+        self.max_run_bytes = max_run_bytes
+        self.sniff_content = sniff_content
+
+    @classmethod
+    def from_environment(cls, **overrides) -> "DownloadPolicy":
+        """
+        Policy configured by SNIPTY_MAX_SNIPPET_BYTES, SNIPTY_MAX_RUN_BYTES and SNIPTY_SNIFF_CONTENT.
+
+        Raises ValueError naming the variable with invalid value.
+        """
+        options = dict(
+            max_snippet_bytes=_environment_size(
+                "SNIPTY_MAX_SNIPPET_BYTES", DEFAULT_MAX_SNIPPET_BYTES
+            ),
+            max_run_bytes=_environment_size("SNIPTY_MAX_RUN_BYTES", 0),
+            sniff_content=os.environ.get("SNIPTY_SNIFF_CONTENT", "") not in ("", "0"),
+        )
+        options.update(overrides)
+        return cls(**options)
+
+    def run_usage(self) -> "RunUsage":
+        """Bytes downloaded under this policy in the current run (fresh count outside of a run)"""
+        return run_memoize(("download_usage", self), RunUsage)
+
+    def downloading(self):
+        """Context manager making a fresh `SnippetBudget` current for downloaders in this thread"""
+        return _current_budget(SnippetBudget(self, self.run_usage()))
+
+
+class RunUsage:
+    """Bytes downloaded during a single run"""
+
+    def __init__(self):
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, url: str, size: int, limit: Union[int, None], consume: bool):
+        with self._lock:
+            if limit is not None and self.size + size > limit:
+                raise DownloaderError(
+                    "{} exceeds limit of {} bytes downloaded in this run".format(
+                        url, limit
+                    )
+                )
+            if consume:
+                self.size += size
+
+
+class SnippetBudget:
+    """Bytes downloaded for a single snippet under `DownloadPolicy`"""
+
+    def __init__(self, policy: DownloadPolicy, run_usage: RunUsage):
+        self.policy = policy
+        self.run_usage = run_usage
+        self.size = 0
+
+    @property
+    def sniff_content(self) -> bool:
+        return self.policy.sniff_content
+
+    def _check(self, url: str, size: int):
+        limit = self.policy.max_snippet_bytes
+        if limit is not None and self.size + size > limit:
+            raise DownloaderError(
+                "{} is larger than snippet limit of {} bytes".format(url, limit)
+            )
+
+    def expect(self, url: str, size: int):
+        """Fail early when announced size (e.g. Content-Length) would exceed limits"""
+        self._check(url, size)
+        self.run_usage.reserve(url, size, self.policy.max_run_bytes, consume=False)
+
+    def consume(self, url: str, size: int):
+        """Account `size` downloaded bytes, fails as soon as limits are exceeded"""
+        self._check(url, size)
+        self.run_usage.reserve(url, size, self.policy.max_run_bytes, consume=True)
+        self.size += size
+
+
+_budget = threading.local()
+
+
+@contextmanager
+def _current_budget(budget: SnippetBudget):
+    previous = getattr(_budget, "current", None)
+    _budget.current = budget
+    try:
+        yield budget
+    finally:
+        _budget.current = previous
+
+
+def download_budget() -> SnippetBudget:
+    """Budget of the snippet being downloaded in this thread (environment limits outside of a run)"""
+    budget = getattr(_budget, "current", None)
+    if budget is None:
+        policy = DownloadPolicy.from_environment()
+        budget = SnippetBudget(policy, policy.run_usage())
+    return budget
+
+
+_run = threading.local()
+
+
+def current_run() -> Union["SingleFlight", None]:
+    """Run activated in this thread by `SingleFlight.activated`"""
+    return getattr(_run, "current", None)
+
+
+def run_memoize(key, compute):
+    """Result of `compute()` computed once per current run (every time outside of a run)"""
+    run = current_run()
+    return compute() if run is None else run.memoize(key, compute)
+
+
+class SingleFlight:
+    """
+    Coalesces downloads of the same snippet within one run.
+
+    Concurrent and repeated requests for the same key (normalized url) share a single fetch; every caller
+    gets its own copy of the downloaded snippet. Download errors are shared as well. Downloaders keep other
+    per run state in it with `run_memoize` (e.g. resolved git refs). Use one instance per run (e.g. as
+    a context manager) - results are never refreshed.
+    """
+
+    def __init__(self):
+        self._paths = {}
+        self._errors = {}
+        self._locks = {}
+        self._memo = {}
+        self._memo_locks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def activated(self):
+        """Make this run current in the calling thread"""
+        previous = current_run()
+        _run.current = self
+        try:
+            yield self
+        finally:
+            _run.current = previous
+
+    def memoize(self, key, compute):
+        with self._lock:
+            key_lock = self._memo_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            if key not in self._memo:
+                self._memo[key] = compute()
+            return self._memo[key]
+
+    def download(self, key: str, fetch) -> str:
+        """Return copy of `fetch()` result, calling it only once per `key`"""
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+
+        # Callers of an in-flight fetch wait here for its result
+        with key_lock:
+            if key in self._errors:
+                raise DownloaderError(str(self._errors[key]))
+            if key not in self._paths:
+                try:
+                    self._paths[key] = fetch()
+                except DownloaderError as e:
+                    self._errors[key] = e
+                    raise
+
+        return copy_download(self._paths[key])
+
+    def close(self):
+        """Remove all downloaded snippets"""
+        with self._lock:
+            for path in self._paths.values():
+                remove_path(path)
+            self._paths.clear()
+            self._errors.clear()
+            self._memo.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 class BaseDownloader:
 
     # @abstractmethod
@@ -26,6 +296,31 @@ class BaseDownloader:
         """Should get the raw snippet content from url and return a path to temporary file or directory"""
         raise NotImplementedError
 
+    @classmethod
+    def normalize_url(cls, url: str) -> str:
+        """Key identifying snippet content regardless of cosmetic url differences"""
+        parsed = urlparse(url)
+        netloc = parsed.netloc.lower()
+        default_port = {"http": ":80", "https": ":443"}.get(parsed.scheme.lower())
+        if default_port and netloc.endswith(default_port):
+            netloc = netloc[: -len(default_port)]
+        return parsed._replace(
+            scheme=parsed.scheme.lower(),
+            netloc=netloc,
+            path=parsed.path.rstrip("/") or "/",
+        ).geturl()
+
+    @classmethod
+    def probe(cls, urls, since: dict = None) -> dict:
+        """
+        Cheaply get upstream validators (e.g. last modification time) of many snippets at once.
+
+        Returns a map of url to validator for every url the downloader could cover. `since` maps urls to
+        timestamps; such url may be mapped to `NOT_MODIFIED` when it did not change after its timestamp.
+        Urls missing in the result (or mapped to None) are unknown.
+        """
+        return {}
+
 
 class BasicDownloader(BaseDownloader):
     """
@@ -34,6 +329,7 @@ class BasicDownloader(BaseDownloader):
 
     ACCEPTED_CONTENT_TYPE = ["text/plain", "application/x-python"]
     ACCEPTED_HTTP_STATUS = 200
+    CHUNK_SIZE = 64 * 1024
 
     @classmethod
     def match(cls, url: str) -> bool:
@@ -47,26 +343,69 @@ class BasicDownloader(BaseDownloader):
         return False
 
     @classmethod
-    def _fetch_file(cls, url: str) -> str:
+    def _looks_like_text(cls, chunk: bytes) -> bool:
+        if b"\0" in chunk:
+            return False
+        try:
+            chunk.decode("utf-8")
+        except UnicodeDecodeError as e:
+            # Multibyte character can be cut by the end of the chunk
+            return e.reason == "unexpected end of data" and e.start >= len(chunk) - 3
+        return True
+
+    @classmethod
+    def _write_response(cls, url: str, response, budget: SnippetBudget, sniff: bool):
         with tempfile.NamedTemporaryFile(
             delete=False, dir=os.environ.get("SNIPTY_TMP")
         ) as destination_file:
-            response = requests.get(url)
+            try:
+                for number, block in enumerate(response.iter_content(cls.CHUNK_SIZE)):
+                    if number == 0 and sniff and not cls._looks_like_text(block):
+                        raise DownloaderError("content of {} is not a text".format(url))
+                    budget.consume(url, len(block))
+                    destination_file.write(block)
+            except BaseException:
+                destination_file.close()
+                os.remove(destination_file.name)
+                raise
+
+            return destination_file.name
+
+    @classmethod
+    def _fetch_file(cls, url: str) -> str:
+        budget = download_budget()
+
+        try:
+            # Streamed, so limits are enforced before the whole body is downloaded
+            response = requests.get(url, stream=True)
+        except requests.RequestException as e:
+            raise DownloaderError("could not fetch {} ({})".format(url, e))
+
+        try:
+            record_http_response(url, response.status_code)
 
             if response.status_code != BasicDownloader.ACCEPTED_HTTP_STATUS:
                 raise DownloaderError(
                     "could not fetch {} (HTTP{})".format(url, response.status_code)
                 )
 
-            if not cls._valid_content_type(response.headers["content-type"]):
+            sniff = not cls._valid_content_type(
+                response.headers.get("content-type", "")
+            )
+            if sniff and not budget.sniff_content:
                 raise DownloaderError(
                     "not a {} format.".format(", ".join(cls.ACCEPTED_CONTENT_TYPE))
                 )
 
-            for block in response.iter_content(1024):
-                destination_file.write(block)
+            content_length = response.headers.get("content-length", "")
+            if content_length.isdigit():
+                budget.expect(url, int(content_length))
 
-            return destination_file.name
+            return cls._write_response(url, response, budget, sniff)
+        except requests.RequestException as e:
+            raise DownloaderError("could not fetch {} ({})".format(url, e))
+        finally:
+            response.close()
 
     @classmethod
     def download(cls, url: str):
@@ -74,7 +413,7 @@ class BasicDownloader(BaseDownloader):
 
 
 class GhostbinDownloader(BasicDownloader):
-    """"
+    """
     Support for ghostbin.com service
 
     Rewrites links to ghostbin to use raw files.
@@ -84,6 +423,11 @@ class GhostbinDownloader(BasicDownloader):
     def match(cls, url: str) -> bool:
         return url.startswith("https://ghostbin.com/paste/")
 
+    @classmethod
+    def normalize_url(cls, url: str) -> str:
+        url = super().normalize_url(url)
+        return url[: -len("/raw")] if url.endswith("/raw") else url
+
     @classmethod
     def download(cls, url: str) -> str:
         # Use native raw support fo ghostbin
@@ -98,6 +442,11 @@ class GistDownloader(BaseDownloader):
     Support for gist.github.com via REST API v3
     """
 
+    # API response carries JSON escaped file contents (quotes and newlines take 2 bytes) and gist
+    # metadata (owner, history), it is bounded by this envelope instead of the snippet limit
+    RESPONSE_ESCAPE_FACTOR = 2
+    RESPONSE_METADATA_BYTES = 1024 * 1024
+
     @classmethod
     def match(cls, url: str) -> bool:
         return urlparse(url).netloc == "gist.github.com"
@@ -107,17 +456,125 @@ class GistDownloader(BaseDownloader):
         return urlparse(url).path.split("/")[-1]
 
     @classmethod
-    def download(cls, url: str) -> str:
-        # Fetch gist from API
-        api_url = "https://api.github.com/gists/{}".format(cls._extract_gist_id(url))
-        response = requests.get(api_url)
+    def normalize_url(cls, url: str) -> str:
+        # Owner part of the url is optional, gist id identifies content
+        return "gist:{}".format(cls._extract_gist_id(url.rstrip("/")))
+
+    @classmethod
+    def _extract_gist_owner(cls, url: str) -> Union[str, None]:
+        path = urlparse(url).path.strip("/").split("/")
+        return path[0] if len(path) == 2 else None
+
+    @classmethod
+    def _list_owner_gists(cls, owner: str, since: float = None) -> dict:
+        """Map of gist id to `updated_at` of all owner's gists (updated after `since`)"""
+        params = {"per_page": 100}
+        if since is not None:
+            params["since"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(since))
+
+        updated = {}
+        api_url = "https://api.github.com/users/{}/gists".format(owner)
+        while api_url:
+            try:
+                response = requests.get(api_url, params=params)
+            except requests.RequestException as e:
+                raise DownloaderError("could not fetch {} ({})".format(api_url, e))
+            record_http_response(api_url, response.status_code)
+
+            if response.status_code != 200:
+                raise DownloaderError(
+                    "could not fetch {} (HTTP{})".format(api_url, response.status_code)
+                )
+
+            for gist in response.json():
+                updated[gist["id"]] = gist["updated_at"]
+
+            # Following pages links already contain all query parameters
+            api_url = response.links.get("next", {}).get("url")
+            params = None
+
+        return updated
 
-        if response.status_code != 200:
+    @classmethod
+    def probe(cls, urls, since: dict = None) -> dict:
+        """Gets `updated_at` of gists using one listing per owner instead of one request per gist"""
+        since = since or {}
+        urls_by_owner = {}
+        for url in urls:
+            owner = cls._extract_gist_owner(url)
+            if owner is not None:
+                urls_by_owner.setdefault(owner, []).append(url)
+
+        validators = {}
+        for owner, owner_urls in urls_by_owner.items():
+            # Listing is limited only when all owner's gists were verified before
+            owner_since = None
+            if all(since.get(url) is not None for url in owner_urls):
+                owner_since = min(since[url] for url in owner_urls)
+
+            try:
+                updated = cls._list_owner_gists(owner, since=owner_since)
+            except DownloaderError as e:
+                logger.warning("Cannot list gists of {} - {}.".format(owner, str(e)))
+                continue
+
+            for url in owner_urls:
+                gist_id = cls._extract_gist_id(url)
+                if gist_id in updated:
+                    validators[url] = updated[gist_id]
+                else:
+                    validators[url] = NOT_MODIFIED if owner_since is not None else None
+
+        return validators
+
+    @classmethod
+    def _check_response_size(cls, api_url: str, size: int, budget: SnippetBudget):
+        limit = budget.policy.max_snippet_bytes
+        if limit is None:
+            return
+        envelope = limit * cls.RESPONSE_ESCAPE_FACTOR + cls.RESPONSE_METADATA_BYTES
+        if size > envelope:
             raise DownloaderError(
-                "could not fetch {} (HTTP{})".format(api_url, response.status_code)
+                "{} response is larger than {} bytes".format(api_url, envelope)
             )
 
-        data = response.json()
+    @classmethod
+    def download(cls, url: str) -> str:
+        # Fetch gist from API
+        api_url = "https://api.github.com/gists/{}".format(cls._extract_gist_id(url))
+        budget = download_budget()
+        try:
+            response = requests.get(api_url, stream=True)
+        except requests.RequestException as e:
+            raise DownloaderError("could not fetch {} ({})".format(api_url, e))
+
+        try:
+            record_http_response(api_url, response.status_code)
+            if response.status_code != 200:
+                raise DownloaderError(
+                    "could not fetch {} (HTTP{})".format(api_url, response.status_code)
+                )
+
+            content_length = response.headers.get("Content-Length", "")
+            if content_length.isdigit():
+                cls._check_response_size(api_url, int(content_length), budget)
+            body = io.BytesIO()
+            for block in response.iter_content(BasicDownloader.CHUNK_SIZE):
+                body.write(block)
+                cls._check_response_size(api_url, body.tell(), budget)
+        except requests.RequestException as e:
+            raise DownloaderError("could not fetch {} ({})".format(api_url, e))
+        finally:
+            response.close()
+
+        data = json.loads(body.getvalue().decode("utf-8"))
+
+        # Sizes are known upfront, nothing is written when the gist is over the limits
+        budget.expect(
+            url, sum(entry.get("size", 0) for entry in data["files"].values())
+        )
+        for entry in data["files"].values():
+            budget.consume(url, len(entry["content"].encode("utf-8")))
 
         if len(data["files"]) == 1:
             # Single file gist
@@ -141,3 +598,244 @@ class GistDownloader(BaseDownloader):
         else:
             # Some error
             raise DownloaderError("there is no snippets in this gist")
+
+
+class GitDownloader(BaseDownloader):
+    """
+    Support for files and directories stored in git repositories
+
+    Urls have form of `git+<repository url>#<path>@<ref>` (e.g. `git+https://host/repo.git#helpers/a.py@main`),
+    `ref` is a branch, a tag or a full commit sha and defaults to HEAD. Every repository has a bare clone in
+    SNIPTY_GIT_CACHE (default: ~/.cache/snipty/git) updated with shallow fetches of the commits only. Refs are
+    resolved once per run (`SingleFlight`), so any number of snippets from one repository and ref costs
+    a single fetch; outside of a run they are resolved on every download.
+    """
+
+    DEFAULT_REF = "HEAD"
+    # Transports able to run commands (e.g. ext::) are never passed to git
+    ALLOWED_SCHEMES = ("https", "ssh", "file")
+
+    _lock = threading.Lock()
+    # Repository url to lock serializing git commands in its cache
+    _repository_locks = {}
+
+    @classmethod
+    def match(cls, url: str) -> bool:
+        return url.startswith("git+")
+
+    @classmethod
+    def _parse_url(cls, url: str) -> tuple:
+        """Split url into `(repository url, path, ref)` refusing values git could take for options"""
+        repository, _, fragment = url[len("git+") :].partition("#")
+        # Paths may contain "@" (e.g. js/@scope/util.js), ref is always after the last one
+        path, _, ref = (
+            fragment.rpartition("@") if "@" in fragment else (fragment, "", "")
+        )
+        ref = ref or cls.DEFAULT_REF
+
+        if urlparse(repository).scheme.lower() not in cls.ALLOWED_SCHEMES:
+            raise DownloaderError(
+                "unsupported git repository {} (use {} urls)".format(
+                    repository, ", ".join(cls.ALLOWED_SCHEMES)
+                )
+            )
+        if ref.startswith("-") or any(char.isspace() for char in ref):
+            raise DownloaderError("invalid git ref {}".format(ref))
+
+        return repository, path.strip("/"), ref
+
+    @classmethod
+    def normalize_url(cls, url: str) -> str:
+        repository, path, ref = cls._parse_url(url)
+        return "git+{}#{}@{}".format(
+            BaseDownloader.normalize_url(repository), path, ref
+        )
+
+    @classmethod
+    def _cache_directory(cls, repository: str) -> str:
+        cache_root = os.environ.get("SNIPTY_GIT_CACHE") or os.path.join(
+            os.path.expanduser("~"), ".cache", "snipty", "git"
+        )
+        key = hashlib.sha1(
+            BaseDownloader.normalize_url(repository).encode("utf-8")
+        ).hexdigest()
+        return os.path.join(cache_root, key)
+
+    @classmethod
+    def _repository_lock(cls, repository: str) -> threading.Lock:
+        with cls._lock:
+            return cls._repository_locks.setdefault(repository, threading.Lock())
+
+    @classmethod
+    def _is_sha(cls, value: str) -> bool:
+        return len(value) == 40 and all(char in "0123456789abcdef" for char in value)
+
+    @classmethod
+    def _resolve_ref(cls, repository: str, ref: str) -> str:
+        if cls._is_sha(ref):
+            return ref
+
+        refs = {}
+        output = run_git("ls-remote", "--", repository, ref).decode("utf-8")
+        for line in output.splitlines():
+            sha, _, name = line.partition("\t")
+            if cls._is_sha(sha):
+                refs[name] = sha
+
+        # Peeled tags point to commits rather than to tag objects
+        for name in (ref, "refs/heads/" + ref, "refs/tags/" + ref + "^{}"):
+            if name in refs:
+                return refs[name]
+        if "refs/tags/" + ref in refs:
+            return refs["refs/tags/" + ref]
+        raise DownloaderError("unknown ref {} in {}".format(ref, repository))
+
+    @classmethod
+    def _commit(cls, repository: str, ref: str) -> tuple:
+        """Resolve ref and make sure its commit is fetched, returns `(cache directory, commit sha)`"""
+        cache_directory = cls._cache_directory(repository)
+        commit = run_memoize(
+            ("git", BaseDownloader.normalize_url(repository), ref),
+            lambda: cls._fetch_commit(repository, ref, cache_directory),
+        )
+        return cache_directory, commit
+
+    @classmethod
+    def _fetch_commit(cls, repository: str, ref: str, cache_directory: str) -> str:
+        with cls._repository_lock(repository):
+            if not os.path.isdir(cache_directory):
+                os.makedirs(os.path.dirname(cache_directory), exist_ok=True)
+                run_git("init", "--quiet", "--bare", "--", cache_directory)
+
+            commit = cls._resolve_ref(repository, ref)
+            try:
+                run_git(
+                    "cat-file", "-e", "--", commit + "^{commit}", cwd=cache_directory
+                )
+            except GitError:
+                logger.info("Fetching {}@{} from {}".format(commit, ref, repository))
+                run_git(
+                    "fetch",
+                    "--quiet",
+                    "--depth",
+                    "1",
+                    "--",
+                    repository,
+                    commit,
+                    cwd=cache_directory,
+                )
+            return commit
+
+    @classmethod
+    def _object_id(cls, url: str) -> tuple:
+        """Returns `(cache directory, object sha, object type)` of the snippet path"""
+        repository, path, ref = cls._parse_url(url)
+        cache_directory, commit = cls._commit(repository, ref)
+
+        try:
+            object_id = (
+                run_git(
+                    "rev-parse",
+                    "--verify",
+                    "--end-of-options",
+                    "{}:{}".format(commit, path),
+                    cwd=cache_directory,
+                )
+                .decode("utf-8")
+                .strip()
+            )
+        except GitError:
+            raise DownloaderError("there is no {} at {}".format(path, ref))
+
+        object_type = (
+            run_git("cat-file", "-t", "--", object_id, cwd=cache_directory)
+            .decode("utf-8")
+            .strip()
+        )
+        return cache_directory, object_id, object_type
+
+    @classmethod
+    def probe(cls, urls, since: dict = None) -> dict:
+        """Validators are git object ids of snippet paths, they change only when the snippet does"""
+        validators = {}
+        for url in urls:
+            try:
+                validators[url] = cls._object_id(url)[1]
+            except (DownloaderError, GitError) as e:
+                logger.warning("Cannot probe {} - {}.".format(url, str(e)))
+        return validators
+
+    @classmethod
+    def _tree_size(cls, cache_directory: str, object_id: str) -> int:
+        output = run_git(
+            "ls-tree", "-r", "-l", "-z", "--", object_id, cwd=cache_directory
+        )
+        # Entries are "<mode> <type> <object> <size>\t<path>", size is "-" for submodules
+        sizes = (
+            entry.split(b"\t")[0].split()[-1] for entry in output.split(b"\0") if entry
+        )
+        return sum(int(size) for size in sizes if size.isdigit())
+
+    @classmethod
+    def _extract_tree(cls, url: str, cache_directory: str, object_id: str) -> str:
+        budget = download_budget()
+        budget.expect(url, cls._tree_size(cache_directory, object_id))
+
+        archive = run_git(
+            "archive", "--format=tar", "--", object_id, cwd=cache_directory
+        )
+        destination_directory = tempfile.mkdtemp(dir=os.environ.get("SNIPTY_TMP"))
+        try:
+            cls._unpack_tree(url, archive, destination_directory, budget)
+        except BaseException:
+            remove_path(destination_directory)
+            raise
+
+        return destination_directory
+
+    @classmethod
+    def _unpack_tree(
+        cls, url: str, archive: bytes, destination_directory: str, budget: SnippetBudget
+    ):
+        with tarfile.open(fileobj=io.BytesIO(archive), mode="r:") as tar:
+            for member in tar.getmembers():
+                member_path = os.path.normpath(
+                    os.path.join(destination_directory, member.name)
+                )
+                if not member_path.startswith(os.path.join(destination_directory, "")):
+                    raise DownloaderError("invalid path {}".format(member.name))
+
+                if member.isdir():
+                    os.makedirs(member_path, exist_ok=True)
+                elif member.isfile():
+                    budget.consume(url, member.size)
+                    os.makedirs(os.path.dirname(member_path), exist_ok=True)
+                    with open(member_path, "wb") as destination_file:
+                        shutil.copyfileobj(tar.extractfile(member), destination_file)
+                # Symlinks and submodules are skipped
+
+    @classmethod
+    def download(cls, url: str) -> str:
+        try:
+            cache_directory, object_id, object_type = cls._object_id(url)
+
+            if object_type == "tree":
+                return cls._extract_tree(url, cache_directory, object_id)
+
+            download_budget().consume(
+                url,
+                int(
+                    run_git(
+                        "cat-file", "-s", "--", object_id, cwd=cache_directory
+                    ).strip()
+                ),
+            )
+            with tempfile.NamedTemporaryFile(
+                delete=False, dir=os.environ.get("SNIPTY_TMP")
+            ) as destination_file:
+                destination_file.write(
+                    run_git("cat-file", "blob", "--", object_id, cwd=cache_directory)
+                )
+                return destination_file.name
+        except GitError as e:
+            raise DownloaderError(str(e))
@@ -0,0 +1,34 @@
+import os
+import subprocess
+
+
+class GitError(Exception):
+    pass
+
+
+def run_git(*args, cwd: str = None) -> bytes:
+    """Run git command and return its standard output"""
+    try:
+        process = subprocess.run(
+            ("git",) + args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+    except OSError as e:
+        raise GitError("cannot run git ({})".format(e))
+
+    if process.returncode != 0:
+        raise GitError(
+            "git {} failed: {}".format(
+                args[0], process.stderr.decode("utf-8", "replace").strip()
+            )
+        )
+    return process.stdout
+
+
+def staged_paths(path: str) -> list:
+    """Absolute paths of files below `path` staged for commit (including deleted ones)"""
+    output = run_git(
+        "diff", "--cached", "--name-only", "--relative", "-z", cwd=path
+    ).decode("utf-8")
+    # Absolute even for relative `path`, callers resolve relative paths against their own roots
+    root = os.path.abspath(path)
+    return [os.path.join(root, name) for name in output.split("\0") if name]
@@ -0,0 +1,198 @@
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Name: (type, help)
+METRICS = {
+    "snipty_snippets_checked_total": (
+        COUNTER,
+        "Snippets checked against their source by status",
+    ),
+    "snipty_snippets_missing_total": (
+        COUNTER,
+        "Tracked snippets checked while not present in the codebase",
+    ),
+    "snipty_snippets_installed_total": (COUNTER, "Snippets placed in the codebase"),
+    "snipty_download_duration_seconds": (
+        HISTOGRAM,
+        "Duration of successful snippet downloads by downloader and host",
+    ),
+    "snipty_download_bytes_total": (
+        COUNTER,
+        "Bytes of downloaded snippets by downloader and host",
+    ),
+    "snipty_download_errors_total": (
+        COUNTER,
+        "Failed snippet downloads by downloader and host",
+    ),
+    "snipty_download_retries_total": (
+        COUNTER,
+        "Downloads repeated from another source (e.g. origin after mirror failure)",
+    ),
+    "snipty_download_cache_hits_total": (
+        COUNTER,
+        "Downloads served from snippets already fetched during the run",
+    ),
+    "snipty_http_responses_total": (COUNTER, "HTTP responses by host and status code"),
+    "snipty_run_duration_seconds": (GAUGE, "Duration of the last snipty run"),
+}
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join('{}="{}"'.format(name, _escape(value)) for name, value in labels)
+    )
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metrics:
+    """
+    Thread safe registry of counters, gauges and histograms declared in `METRICS`.
+
+    Metrics are rendered in Prometheus text exposition format, e.g. for node_exporter textfile collector.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Name to map of sorted labels tuple to value (histograms: [bucket counts, sum, count])
+        self._samples = {}
+
+    def _series(self, name: str, labels: dict):
+        if name not in METRICS:
+            raise KeyError("unknown metric {}".format(name))
+        return self._samples.setdefault(name, {}), tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            series, key = self._series(name, labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            series, key = self._series(name, labels)
+            series[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        with self._lock:
+            series, key = self._series(name, labels)
+            buckets, total, count = series.get(
+                key, ([0] * len(DURATION_BUCKETS), 0.0, 0)
+            )
+            buckets = [
+                bucket_count + (1 if value <= bound else 0)
+                for bucket_count, bound in zip(buckets, DURATION_BUCKETS)
+            ]
+            series[key] = (buckets, total + value, count + 1)
+
+    def value(self, name: str, **labels):
+        """Current value of a counter or gauge (histograms: number of observations)"""
+        with self._lock:
+            series, key = self._series(name, labels)
+            value = series.get(key, 0)
+        return value[2] if isinstance(value, tuple) else value
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name in sorted(self._samples):
+                metric_type, help_text = METRICS[name]
+                lines.append("# HELP {} {}".format(name, help_text))
+                lines.append("# TYPE {} {}".format(name, metric_type))
+
+                for labels, value in sorted(self._samples[name].items()):
+                    if metric_type != HISTOGRAM:
+                        lines.append(
+                            "{}{} {}".format(
+                                name, _format_labels(labels), _format_value(value)
+                            )
+                        )
+                        continue
+
+                    buckets, total, count = value
+                    for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                        lines.append(
+                            "{}_bucket{} {}".format(
+                                name,
+                                _format_labels(labels + (("le", repr(bound)),)),
+                                bucket_count,
+                            )
+                        )
+                    lines.append(
+                        "{}_bucket{} {}".format(
+                            name, _format_labels(labels + (("le", "+Inf"),)), count
+                        )
+                    )
+                    lines.append(
+                        "{}_sum{} {}".format(
+                            name, _format_labels(labels), _format_value(total)
+                        )
+                    )
+                    lines.append(
+                        "{}_count{} {}".format(name, _format_labels(labels), count)
+                    )
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Atomically replace `path` with rendered metrics (collectors never see partial file)"""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, "w") as f:
+            f.write(self.render())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+
+def url_host(url: str) -> str:
+    return urlparse(url).hostname or ""
+
+
+def path_size(path: str) -> int:
+    """Size of downloaded file or all files of downloaded directory"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, file_name))
+        for root, _, file_names in os.walk(path)
+        for file_name in file_names
+    )
+
+
+_recording = threading.local()
+
+
+@contextmanager
+def recording(metrics: Metrics):
+    """Record HTTP responses received by downloaders in the current thread into `metrics`"""
+    previous = getattr(_recording, "metrics", None)
+    _recording.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _recording.metrics = previous
+
+
+def record_http_response(url: str, status_code: int):
+    metrics = getattr(_recording, "metrics", None)
+    if metrics is not None:
+        metrics.inc(
+            "snipty_http_responses_total", host=url_host(url), code=str(status_code)
+        )
@@ -0,0 +1,277 @@
+import hashlib
+import io
+import logging
+import os
+import tarfile
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from snipty.downloaders import (
+    DownloaderError,
+    DownloadPolicy,
+    download_budget,
+    remove_path,
+)
+from snipty.metrics import record_http_response
+
+logger = logging.getLogger("snipty")
+
+KIND_FILE = "file"
+KIND_DIR = "dir"
+
+# Mirror is reachable by anyone who can connect, it fetches only urls of these hosts by default
+DEFAULT_ALLOWED_HOSTS = ("gist.github.com", "ghostbin.com")
+DEFAULT_ALLOWED_SCHEMES = ("https",)
+DEFAULT_MAX_ENTRIES = 1024
+# Schemes a mirror can ever be allowed to serve (local repositories of clients never leave them)
+MIRRORABLE_SCHEMES = ("https", "http", "git+https", "git+ssh")
+# Concurrent fetches of urls sharing a lock are serialized (bounded number of locks for any number of urls)
+URL_LOCKS = 64
+
+
+class MirrorRefusedError(DownloaderError):
+    """Mirror is not allowed to serve the url, it does not mean the mirror is failing"""
+
+
+def mirrorable(url: str) -> bool:
+    """Whether a mirror can serve `url` at all (e.g. never git+file urls)"""
+    return urlparse(url).scheme.lower() in MIRRORABLE_SCHEMES
+
+
+class MirrorEntry:
+    """Single cached snippet payload kept by the mirror"""
+
+    def __init__(self, kind: str, payload: bytes):
+        self.kind = kind
+        self.payload = payload
+        self.etag = '"{}"'.format(hashlib.sha1(payload).hexdigest())
+        self.fetched_at = time.monotonic()
+
+
+class MirrorCache:
+    """
+    Keeps downloaded snippets in memory for `ttl` seconds.
+
+    Expired entries are revalidated against the origin; if the origin fails the stale entry is
+    served rather than an error. Concurrent requests for the same URL share one origin fetch.
+    Only urls with `allowed_schemes` and `allowed_hosts` are fetched; at most `max_entries` least
+    recently used snippets are kept. Origin fetches are limited by `policy` (environment limits by default).
+    """
+
+    def __init__(
+        self,
+        downloaders,
+        ttl: float = 300,
+        allowed_hosts=DEFAULT_ALLOWED_HOSTS,
+        allowed_schemes=DEFAULT_ALLOWED_SCHEMES,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        policy: DownloadPolicy = None,
+    ):
+        self.downloaders = downloaders
+        self.policy = (
+            policy if policy is not None else DownloadPolicy.from_environment()
+        )
+        self.ttl = ttl
+        self.allowed_hosts = {host.lower() for host in allowed_hosts}
+        self.allowed_schemes = set(allowed_schemes)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._locks = [threading.Lock() for _ in range(URL_LOCKS)]
+        self._lock = threading.Lock()
+
+    def _url_lock(self, url: str) -> threading.Lock:
+        return self._locks[
+            int(hashlib.sha1(url.encode("utf-8")).hexdigest(), 16) % URL_LOCKS
+        ]
+
+    def allows(self, url: str) -> bool:
+        parsed = urlparse(url)
+        return (
+            parsed.scheme.lower() in self.allowed_schemes
+            and (parsed.hostname or "") in self.allowed_hosts
+        )
+
+    def _cached(self, url: str):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def _store(self, url: str, entry: MirrorEntry):
+        with self._lock:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _dispatch(self, url: str):
+        for downloader in self.downloaders:
+            if downloader.match(url):
+                return downloader
+        raise DownloaderError("cannot find downloader for provided url {}".format(url))
+
+    def _fetch(self, url: str) -> MirrorEntry:
+        downloader = self._dispatch(url)
+        with self.policy.downloading():
+            tmp_path = downloader.download(url=url)
+        try:
+            if os.path.isdir(tmp_path):
+                return MirrorEntry(KIND_DIR, pack_directory(tmp_path))
+            with open(tmp_path, "rb") as f:
+                return MirrorEntry(KIND_FILE, f.read())
+        finally:
+            remove_path(tmp_path)
+
+    def get(self, url: str) -> MirrorEntry:
+        if not self.allows(url):
+            raise DownloaderError("mirroring of {} is not allowed".format(url))
+
+        with self._url_lock(url):
+            entry = self._cached(url)
+            if entry is not None and time.monotonic() - entry.fetched_at < self.ttl:
+                return entry
+
+            try:
+                fresh = self._fetch(url)
+            except DownloaderError as e:
+                if entry is None:
+                    raise
+                logger.warning("Serving stale {} - origin failed ({}).".format(url, e))
+                return entry
+
+            if entry is not None and entry.etag == fresh.etag:
+                # Revalidated - keep the old object, only extend its lifetime
+                entry.fetched_at = fresh.fetched_at
+                return entry
+
+            self._store(url, fresh)
+            return fresh
+
+
+def pack_directory(path: str) -> bytes:
+    """Pack multi file snippet directory into gzipped tar archive"""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for file_name in sorted(os.listdir(path)):
+            archive.add(os.path.join(path, file_name), arcname=file_name)
+    return buffer.getvalue()
+
+
+def unpack_directory(payload: bytes, destination: str):
+    """Unpack archive created by `pack_directory` refusing paths escaping destination"""
+    with tarfile.open(fileobj=io.BytesIO(payload), mode="r:gz") as archive:
+        for member in archive.getmembers():
+            member_path = os.path.normpath(os.path.join(destination, member.name))
+            if not member_path.startswith(os.path.join(destination, "")):
+                raise DownloaderError(
+                    "invalid path {} in mirror response".format(member.name)
+                )
+            if not (member.isfile() or member.isdir()):
+                raise DownloaderError(
+                    "invalid entry {} in mirror response".format(member.name)
+                )
+        archive.extractall(destination)
+
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        request = urlparse(self.path)
+        url = parse_qs(request.query).get("url", [None])[0]
+
+        if request.path != "/snippet" or not url:
+            self.send_error(404)
+            return
+
+        if not self.server.cache.allows(url):
+            self.send_error(403, "Mirroring of this url is not allowed")
+            return
+
+        try:
+            entry = self.server.cache.get(url)
+        except DownloaderError as e:
+            self.send_error(502, str(e))
+            return
+
+        if self.headers.get("If-None-Match") == entry.etag:
+            self.send_response(304)
+            self.send_header("ETag", entry.etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(entry.payload)))
+        self.send_header("ETag", entry.etag)
+        self.send_header("X-Snipty-Kind", entry.kind)
+        self.end_headers()
+        self.wfile.write(entry.payload)
+
+    def log_message(self, format, *args):
+        logger.info("{} - {}".format(self.address_string(), format % args))
+
+
+class MirrorServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, downloaders, ttl: float = 300, **cache_options):
+        super().__init__(server_address, MirrorRequestHandler)
+        self.cache = MirrorCache(downloaders, ttl=ttl, **cache_options)
+
+
+def fetch_from_mirror(mirror_url: str, url: str, timeout: float = 30) -> str:
+    """Get snippet from a running `snipty serve` mirror; returns path like `BaseDownloader.download`"""
+    budget = download_budget()
+    try:
+        response = requests.get(
+            mirror_url.rstrip("/") + "/snippet",
+            params={"url": url},
+            timeout=timeout,
+            stream=True,
+        )
+    except requests.RequestException as e:
+        raise DownloaderError("mirror {} is not reachable ({})".format(mirror_url, e))
+
+    try:
+        record_http_response(mirror_url, response.status_code)
+        if response.status_code == 403:
+            raise MirrorRefusedError(
+                "mirroring of {} is not allowed by the mirror".format(url)
+            )
+        if response.status_code != 200:
+            raise DownloaderError(
+                "could not fetch {} from mirror (HTTP{})".format(
+                    url, response.status_code
+                )
+            )
+
+        content_length = response.headers.get("Content-Length", "")
+        if content_length.isdigit():
+            budget.expect(url, int(content_length))
+
+        payload = io.BytesIO()
+        for block in response.iter_content(64 * 1024):
+            budget.consume(url, len(block))
+            payload.write(block)
+    except requests.RequestException as e:
+        raise DownloaderError("mirror {} failed ({})".format(mirror_url, e))
+    finally:
+        response.close()
+
+    if response.headers.get("X-Snipty-Kind") == KIND_DIR:
+        destination_directory = tempfile.mkdtemp(dir=os.environ.get("SNIPTY_TMP"))
+        unpack_directory(payload.getvalue(), destination_directory)
+        return destination_directory
+
+    with tempfile.NamedTemporaryFile(
+        delete=False, dir=os.environ.get("SNIPTY_TMP")
+    ) as destination_file:
+        destination_file.write(payload.getvalue())
+        return destination_file.name
@@ -0,0 +1,97 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from snipty.base import SniptyCriticalError
+from snipty.downloaders import SingleFlight
+
+logger = logging.getLogger("snipty")
+
+CONFIG_FILE_NAME = "snipty.yml"
+
+SKIP_DIRECTORIES = {
+    "node_modules",
+    "__pycache__",
+    "venv",
+    "build",
+    "dist",
+    "site-packages",
+}
+
+
+def discover_roots(top: str) -> list:
+    """Find all project roots (directories containing snipty.yml) below `top`"""
+    roots = []
+    for root, dirs, files in os.walk(top):
+        dirs[:] = sorted(
+            d for d in dirs if not d.startswith(".") and d not in SKIP_DIRECTORIES
+        )
+        if CONFIG_FILE_NAME in files:
+            roots.append(root)
+    return roots
+
+
+_root = threading.local()
+
+
+class RootLogFilter(logging.Filter):
+    """Prefix messages logged while processing a project root with its label (roots run concurrently)"""
+
+    def filter(self, record):
+        label = getattr(_root, "label", None)
+        if label is not None:
+            record.msg = "{}: {}".format(label, record.getMessage())
+            record.args = ()
+        return True
+
+
+logger.addFilter(RootLogFilter())
+
+
+class RootResult:
+    """Outcome of running a command on a single project root (`failed` when it stopped with an error)"""
+
+    def __init__(self, root: str, exit_code: int, value=None, failed: bool = False):
+        self.root = root
+        self.exit_code = exit_code
+        self.value = value
+        self.failed = failed
+
+
+def run_recursive(
+    roots,
+    action,
+    snipty_class,
+    workers=None,
+    downloads=None,
+    metrics=None,
+    policy=None,
+    label=None,
+) -> list:
+    """
+    Run `action(snipty)` for every root concurrently sharing downloads of identical urls.
+
+    `action` returns a tuple `(exit_code, value)`. Results are returned in the order of `roots`. Every root
+    records into `metrics` (`Metrics`) and downloads within `policy` (`DownloadPolicy`) limits when given.
+    Messages logged for a root are prefixed with `label(root)` (the root itself by default).
+    """
+    if downloads is None:
+        with SingleFlight() as downloads:
+            return run_recursive(
+                roots, action, snipty_class, workers, downloads, metrics, policy, label
+            )
+
+    def run(root):
+        snipty = snipty_class(root, downloads=downloads, metrics=metrics, policy=policy)
+        _root.label = root if label is None else label(root)
+        try:
+            exit_code, value = action(snipty)
+        except SniptyCriticalError as e:
+            return RootResult(root, e.code, failed=True)
+        finally:
+            _root.label = None
+        return RootResult(root, exit_code, value)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run, roots))
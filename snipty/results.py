@@ -0,0 +1,47 @@
+from typing import NamedTuple, Optional, Tuple
+
+
+class SnippetStatus:
+    UP_TO_DATE = "up_to_date"
+    CHANGED = "changed"
+    NOT_TRACKED = "not_tracked"
+    ERROR = "error"
+
+
+class FileStatus:
+    SAME = "same"
+    CHANGED = "changed"
+    # Present only in the source
+    ADDED = "added"
+    # Present only locally
+    REMOVED = "removed"
+
+
+class FileResult(NamedTuple):
+    """Comparison result of a single file of multi file snippet"""
+
+    path: str
+    status: str
+
+
+class CheckResult(NamedTuple):
+    """Result of checking a single snippet against its source"""
+
+    name: str
+    url: Optional[str]
+    status: str
+    # Per file results (only for multi file snippets)
+    files: Tuple[FileResult, ...] = ()
+    local_hash: Optional[str] = None
+    upstream_hash: Optional[str] = None
+    # Seconds spent on checking
+    duration: float = 0.0
+    # Result was taken from incremental check state without downloading the snippet
+    cached: bool = False
+    error: Optional[str] = None
+    # Offset of the first differing byte of changed single file snippet of unchanged size
+    first_difference: Optional[int] = None
+
+    @property
+    def up_to_date(self) -> bool:
+        return self.status == SnippetStatus.UP_TO_DATE
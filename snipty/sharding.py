@@ -0,0 +1,58 @@
+import hashlib
+import json
+
+
+def parse_shard(value: str) -> tuple:
+    """Parse "INDEX/TOTAL" (1-based index) shard specification"""
+    try:
+        index, total = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise ValueError("shard must be given as INDEX/TOTAL, e.g. 1/4")
+
+    if total < 1 or not 1 <= index <= total:
+        raise ValueError("shard index must be between 1 and {}".format(total))
+    return index, total
+
+
+def load_timings(path: str) -> dict:
+    """Load `{"snippet name": seconds}` map of historical check durations"""
+    with open(path, "r") as f:
+        timings = json.load(f)
+
+    if not isinstance(timings, dict):
+        raise ValueError(
+            "timings file must contain a mapping of snippet name to seconds"
+        )
+    return {name: float(seconds) for name, seconds in timings.items()}
+
+
+def _stable_hash(name: str) -> int:
+    # Python hash() is randomized per process, every CI node must compute the same value
+    return int(hashlib.sha1(name.encode("utf-8")).hexdigest(), 16)
+
+
+def shard_names(names, index: int, total: int, timings: dict = None) -> list:
+    """
+    Deterministically select names belonging to shard `index` (1-based) of `total`.
+
+    Without `timings` names are assigned by a stable hash. With `timings` names are distributed greedily
+    (longest first) so every shard gets similar total duration; names without timing get the average one.
+    Order of `names` is preserved in the result.
+    """
+    names = list(names)
+
+    if not timings:
+        return [name for name in names if _stable_hash(name) % total == index - 1]
+
+    known = [timings[name] for name in names if name in timings]
+    default = sum(known) / len(known) if known else 1.0
+
+    loads = [0.0] * total
+    assigned = set()
+    for name in sorted(names, key=lambda name: (-timings.get(name, default), name)):
+        shard = min(range(total), key=lambda shard: (loads[shard], shard))
+        loads[shard] += timings.get(name, default)
+        if shard == index - 1:
+            assigned.add(name)
+
+    return [name for name in names if name in assigned]
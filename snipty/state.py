@@ -0,0 +1,81 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger("snipty")
+
+STATE_FILE_NAME = ".snipty-state.json"
+STATE_VERSION = 1
+
+
+class SniptyState:
+    """
+    Persisted results of the last successful verification of snippets.
+
+    For every snippet it keeps when it was verified, digest of the local copy and (optional) downloader
+    specific upstream validator. The file is only a cache - when it is missing or broken all snippets are
+    simply verified again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._snippets = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring broken state file {} ({}).".format(self.path, e))
+            return {}
+
+        if not isinstance(data, dict) or data.get("version") != STATE_VERSION:
+            return {}
+        return data.get("snippets", {})
+
+    def get(self, name: str):
+        return self._snippets.get(name)
+
+    def record(
+        self,
+        name: str,
+        local_digest: str,
+        validator: str = None,
+        verified_at: float = None,
+    ):
+        with self._lock:
+            self._snippets[name] = {
+                "verified_at": time.time() if verified_at is None else verified_at,
+                "local_digest": local_digest,
+                "validator": validator,
+            }
+
+    def forget(self, name: str):
+        with self._lock:
+            self._snippets.pop(name, None)
+
+    def is_fresh(self, name: str, local_digest: str, max_age: float) -> bool:
+        """Snippet was verified less than `max_age` seconds ago and local copy did not change since"""
+        entry = self.get(name)
+        return (
+            entry is not None
+            and local_digest is not None
+            and entry["local_digest"] == local_digest
+            and time.time() - entry["verified_at"] < max_age
+        )
+
+    def save(self):
+        with self._lock:
+            data = {"version": STATE_VERSION, "snippets": self._snippets}
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.path))
+            )
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
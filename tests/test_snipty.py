@@ -1,10 +1,37 @@
+import io
+import json
+import logging
 import os
+import shutil
+import subprocess
+import tarfile
 import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 import pytest
 
 from snipty.base import Snipty, SniptyCriticalError
-from snipty.downloaders import BaseDownloader, DownloaderError
+from snipty.compare import DigestCache, compare_files, compare_trees
+from snipty.downloaders import (
+    BaseDownloader,
+    BasicDownloader,
+    DownloaderError,
+    DownloadPolicy,
+    GhostbinDownloader,
+    GistDownloader,
+    GitDownloader,
+    NOT_MODIFIED,
+    SingleFlight,
+    parse_size,
+)
+from snipty.git import run_git
+from snipty.metrics import Metrics, record_http_response, recording
+from snipty.mirror import MirrorCache, MirrorServer, fetch_from_mirror
+from snipty.monorepo import discover_roots, run_recursive
+from snipty.results import FileResult, FileStatus, SnippetStatus
+from snipty.sharding import parse_shard, shard_names
 
 
 class DummyDownloader(BaseDownloader):
@@ -260,3 +287,1226 @@ def test_check_all_2():
         with open(os.path.join(project_root, "2.py"), "a") as f:
             f.write("diff")
         assert snipty.check_all() == 2
+
+
+class CountingDirectoryDownloader(BaseDownloader):
+    calls = 0
+
+    @classmethod
+    def match(cls, url: str) -> bool:
+        return True
+
+    @classmethod
+    def download(cls, url: str) -> str:
+        cls.calls += 1
+        directory = tempfile.mkdtemp()
+        for file_name in ("a.py", "b.py"):
+            with open(os.path.join(directory, file_name), "w") as f:
+                f.write(file_name)
+        return directory
+
+
+def start_mirror(downloaders, ttl=300, **cache_options):
+    cache_options.setdefault("allowed_hosts", ["test.url"])
+    cache_options.setdefault("allowed_schemes", ["http"])
+    server = MirrorServer(
+        ("127.0.0.1", 0), downloaders=downloaders, ttl=ttl, **cache_options
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}".format(server.server_address[1])
+
+
+def test_mirror_serves_cached_directory():
+    CountingDirectoryDownloader.calls = 0
+    server, mirror_url = start_mirror([CountingDirectoryDownloader])
+    try:
+        for _ in range(2):
+            path = fetch_from_mirror(mirror_url, "http://test.url/dir")
+            assert sorted(os.listdir(path)) == ["a.py", "b.py"]
+            assert_file_content(os.path.join(path, "b.py"), "b.py")
+        assert CountingDirectoryDownloader.calls == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_mirror_install_package(monkeypatch):
+    server, mirror_url = start_mirror([DummyDownloader])
+    monkeypatch.setenv("SNIPTY_MIRROR", mirror_url)
+    try:
+        with tempfile.TemporaryDirectory() as project_root:
+            snipty = Snipty(project_root)
+            snipty.install_package(url="http://test.url/1.txt", name="1.py")
+            assert_file_content(os.path.join(project_root, "1.py"), "test")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_mirror_refuses_urls_not_allowed():
+    CountingDirectoryDownloader.calls = 0
+    server, mirror_url = start_mirror([CountingDirectoryDownloader])
+    try:
+        for url in (
+            "http://internal.host/dir",
+            "https://test.url/dir",
+            "git+file:///srv/repo#a.py",
+        ):
+            with pytest.raises(DownloaderError):
+                fetch_from_mirror(mirror_url, url)
+        assert CountingDirectoryDownloader.calls == 0
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_mirror_cache_evicts_least_recently_used():
+    cache = MirrorCache(
+        [DummyDownloader],
+        allowed_hosts=["test.url"],
+        allowed_schemes=["http"],
+        max_entries=2,
+    )
+    for name in ("1", "2", "1", "3"):
+        cache.get("http://test.url/" + name)
+    assert list(cache._entries) == ["http://test.url/1", "http://test.url/3"]
+
+
+def test_mirror_unreachable_falls_back_to_origin(monkeypatch):
+    monkeypatch.setenv("SNIPTY_MIRROR", "http://127.0.0.1:1")
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = DummyDownloaderSnipty(project_root)
+        snipty.install_package(url="http://test.url/1.txt", name="1.py")
+        assert_file_content(os.path.join(project_root, "1.py"), "test")
+
+
+def test_mirror_skipped_for_urls_it_cannot_serve(monkeypatch):
+    server, mirror_url = start_mirror([DummyDownloader])
+    monkeypatch.setenv("SNIPTY_MIRROR", mirror_url)
+    metrics = Metrics()
+    try:
+        with tempfile.TemporaryDirectory() as project_root:
+            snipty = DummyDownloaderSnipty(project_root, metrics=metrics)
+            # Refused by mirror (host not allowed) and never sent to it (local repository)
+            snipty.install_package(url="http://other.url/1.txt", name="1.py")
+            snipty.install_package(url="git+file:///srv/repo#a.py", name="a.py")
+            assert_file_content(os.path.join(project_root, "a.py"), "test")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert metrics.value("snipty_download_retries_total", reason="mirror") == 0
+    assert (
+        metrics.value("snipty_http_responses_total", host="127.0.0.1", code="403") == 1
+    )
+
+
+class DirectoryDownloaderSnipty(Snipty):
+    SUPPORTED_DOWNLOADERS = [CountingDirectoryDownloader]
+
+
+def test_bundle_restore():
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = DummyDownloaderSnipty(project_root)
+        snipty.install_package(url="http://test.url/1.txt", name="1.py")
+        snipty.install_package(url="http://test.url/2.txt", name="sub/2.py")
+        bundle_path = os.path.join(project_root, "snippets.tar.gz")
+        snipty.bundle(bundle_path)
+
+        os.remove(os.path.join(project_root, "1.py"))
+        os.remove(os.path.join(project_root, "sub", "2.py"))
+
+        offline = Snipty(project_root)
+        offline.SUPPORTED_DOWNLOADERS = []
+        offline.install_missing(bundle=bundle_path, names=["sub/2.py"])
+        assert not os.path.exists(os.path.join(project_root, "1.py"))
+        assert_file_content(os.path.join(project_root, "sub", "2.py"), "test")
+
+        offline.install_missing(bundle=bundle_path)
+        assert_file_content(os.path.join(project_root, "1.py"), "test")
+
+
+def test_bundle_restore_directory():
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = DirectoryDownloaderSnipty(project_root)
+        snipty.install_package(url="http://test.url/dir", name="multi")
+        bundle_path = os.path.join(project_root, "snippets.tar.gz")
+        snipty.bundle(bundle_path)
+        shutil.rmtree(os.path.join(project_root, "multi"))
+
+        snipty.install_missing(bundle=bundle_path)
+        assert sorted(os.listdir(os.path.join(project_root, "multi"))) == [
+            "a.py",
+            "b.py",
+        ]
+
+
+def test_bundle_restore_hash_mismatch():
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = DummyDownloaderSnipty(project_root)
+        snipty.install_package(url="http://test.url/1.txt", name="1.py")
+        bundle_path = os.path.join(project_root, "snippets.tar.gz")
+        snipty.bundle(bundle_path)
+
+        with tarfile.open(bundle_path, "r:gz") as archive:
+            members = [(m, archive.extractfile(m).read()) for m in archive]
+        with tarfile.open(bundle_path, "w:gz") as archive:
+            for member, data in members:
+                if member.name == "snippets/1.py":
+                    data = b"evil"
+                    member.size = len(data)
+                archive.addfile(member, io.BytesIO(data))
+
+        os.remove(os.path.join(project_root, "1.py"))
+        with pytest.raises(SniptyCriticalError):
+            snipty.install_missing(bundle=bundle_path)
+        assert not os.path.exists(os.path.join(project_root, "1.py"))
+
+
+class CountingDownloader(DummyDownloader):
+    calls = 0
+
+    @classmethod
+    def download(cls, url: str) -> str:
+        cls.calls += 1
+        return super().download(url)
+
+
+class CountingDownloaderSnipty(Snipty):
+    SUPPORTED_DOWNLOADERS = [CountingDownloader]
+
+
+def test_discover_roots():
+    with tempfile.TemporaryDirectory() as top:
+        for root in ("a", "b/c", ".git/d", "node_modules/e"):
+            os.makedirs(os.path.join(top, root))
+            with open(os.path.join(top, root, "snipty.yml"), "w") as f:
+                f.write("{}\n")
+
+        assert discover_roots(top) == [
+            os.path.join(top, "a"),
+            os.path.join(top, "b", "c"),
+        ]
+
+
+def test_run_recursive_fetches_shared_url_once():
+    CountingDownloader.calls = 0
+    with tempfile.TemporaryDirectory() as top:
+        roots = []
+        for root in ("a", "b", "c"):
+            snipty = DummyDownloaderSnipty(os.path.join(top, root))
+            os.makedirs(snipty.project_root)
+            snipty.install_package(url="http://test.url/1.txt", name="1.py")
+            roots.append(snipty.project_root)
+        with open(os.path.join(top, "c", "1.py"), "a") as f:
+            f.write("diff")
+
+        results = run_recursive(
+            discover_roots(top),
+            lambda snipty: (snipty.check_all(), None),
+            snipty_class=CountingDownloaderSnipty,
+        )
+
+        assert [(r.root, r.exit_code) for r in results] == [
+            (roots[0], 0),
+            (roots[1], 0),
+            (roots[2], 1),
+        ]
+        assert CountingDownloader.calls == 1
+        assert not any(r.failed for r in results)
+
+
+def test_run_recursive_reports_failed_roots_separately():
+    class ErrorDownloader(DummyDownloader):
+        @classmethod
+        def download(cls, url: str) -> str:
+            raise DownloaderError("gone")
+
+    class ErrorSnipty(Snipty):
+        SUPPORTED_DOWNLOADERS = [ErrorDownloader]
+
+    with tempfile.TemporaryDirectory() as top:
+        os.makedirs(os.path.join(top, "a"))
+        with open(os.path.join(top, "a", "snipty.yml"), "w") as f:
+            f.write("1.py: http://test.url/1.txt\n")
+
+        (result,) = run_recursive(
+            discover_roots(top),
+            lambda snipty: (snipty.check_all(), None),
+            snipty_class=ErrorSnipty,
+        )
+
+        assert (result.exit_code, result.failed) == (1, True)
+
+
+def test_run_recursive_labels_messages_with_root(caplog):
+    caplog.set_level(logging.INFO, logger="snipty")
+    with tempfile.TemporaryDirectory() as top:
+        for root in ("a", "b"):
+            snipty = DummyDownloaderSnipty(os.path.join(top, root))
+            os.makedirs(snipty.project_root)
+            snipty.install_package(url="http://test.url/1.txt", name="1.py")
+        caplog.clear()
+
+        run_recursive(
+            discover_roots(top),
+            lambda snipty: (snipty.check_all(), None),
+            snipty_class=DummyDownloaderSnipty,
+            label=lambda root: os.path.relpath(root, top),
+        )
+
+        assert sorted(caplog.messages) == [
+            "a: ✔ Snippet 1.py present and up to date.",
+            "b: ✔ Snippet 1.py present and up to date.",
+        ]
+        # Messages logged outside of recursive run are not labelled
+        caplog.clear()
+        DummyDownloaderSnipty(os.path.join(top, "a")).check_all()
+        assert caplog.messages == ["✔ Snippet 1.py present and up to date."]
+
+
+def test_check_incremental():
+    CountingDownloader.calls = 0
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = CountingDownloaderSnipty(project_root)
+        snipty.install_package(url="http://test.url/1.txt", name="1.py")
+        snipty.install_package(url="http://test.url/2.txt", name="2.py")
+        CountingDownloader.calls = 0
+
+        assert snipty.check_all(incremental=True) == 0
+        assert CountingDownloader.calls == 2
+
+        assert CountingDownloaderSnipty(project_root).check_all(incremental=True) == 0
+        assert CountingDownloader.calls == 2
+
+        with open(os.path.join(project_root, "2.py"), "a") as f:
+            f.write("diff")
+        assert snipty.check_all(incremental=True) == 1
+        assert CountingDownloader.calls == 3
+
+        assert snipty.check_all(incremental=True, refresh=True) == 1
+        assert CountingDownloader.calls == 5
+
+        assert snipty.check_all(incremental=True, max_age=0) == 1
+        assert CountingDownloader.calls == 7
+
+
+class ProbingDownloader(CountingDownloader):
+    version = "v1"
+    probes = []
+
+    @classmethod
+    def probe(cls, urls, since=None):
+        cls.probes.append(since)
+        return {url: cls.version for url in urls}
+
+
+class ProbingDownloaderSnipty(Snipty):
+    SUPPORTED_DOWNLOADERS = [ProbingDownloader]
+
+
+def test_check_incremental_uses_upstream_probe():
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = ProbingDownloaderSnipty(project_root)
+        snipty.install_package(url="http://test.url/1.txt", name="1.py")
+        snipty.install_package(url="http://test.url/2.txt", name="2.py")
+        ProbingDownloader.calls = 0
+        ProbingDownloader.probes = []
+
+        assert snipty.check_all(incremental=True) == 0
+        assert ProbingDownloader.calls == 2
+        # Nothing verified yet - current validators of all snippets are needed
+        assert ProbingDownloader.probes == [{}]
+
+        # Expired but upstream validators did not change - nothing is downloaded
+        assert snipty.check_all(incremental=True, max_age=0) == 0
+        assert ProbingDownloader.calls == 2
+        assert sorted(ProbingDownloader.probes[1]) == [
+            "http://test.url/1.txt",
+            "http://test.url/2.txt",
+        ]
+
+        ProbingDownloader.version = "v2"
+        assert snipty.check_all(incremental=True, max_age=0) == 0
+        assert ProbingDownloader.calls == 4
+
+
+def test_gist_probe_lists_gists_per_owner(monkeypatch):
+    requested = []
+
+    class Response:
+        status_code = 200
+
+        def __init__(self, url):
+            self.url = url
+            self.links = {}
+            if url.endswith("/alice/gists"):
+                self.links = {"next": {"url": url + "?page=2"}}
+
+        def json(self):
+            if self.url.endswith("page=2"):
+                return [{"id": "b2", "updated_at": "2018-02-01T00:00:00Z"}]
+            if "/alice/" in self.url:
+                return [{"id": "a1", "updated_at": "2018-01-01T00:00:00Z"}]
+            return []
+
+    def get(url, params=None):
+        requested.append(url)
+        return Response(url)
+
+    monkeypatch.setattr("snipty.downloaders.requests.get", get)
+
+    validators = GistDownloader.probe(
+        [
+            "https://gist.github.com/alice/a1",
+            "https://gist.github.com/alice/b2",
+            "https://gist.github.com/bob/c3",
+            "https://gist.github.com/d4",
+        ]
+    )
+
+    assert validators == {
+        "https://gist.github.com/alice/a1": "2018-01-01T00:00:00Z",
+        "https://gist.github.com/alice/b2": "2018-02-01T00:00:00Z",
+        "https://gist.github.com/bob/c3": None,
+    }
+    assert len(requested) == 3
+
+
+class NestedDirectoryDownloader(BaseDownloader):
+    @classmethod
+    def match(cls, url: str) -> bool:
+        return True
+
+    @classmethod
+    def download(cls, url: str) -> str:
+        directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(directory, "sub"))
+        for file_name in ("a.py", os.path.join("sub", "b.py")):
+            with open(os.path.join(directory, file_name), "w") as f:
+                f.write(file_name)
+        return directory
+
+
+class NestedDirectoryDownloaderSnipty(Snipty):
+    SUPPORTED_DOWNLOADERS = [NestedDirectoryDownloader]
+
+
+def test_compare_trees():
+    with tempfile.TemporaryDirectory() as local, tempfile.TemporaryDirectory() as source:
+        for root, files in ((local, ["a", "c/d", "c/e"]), (source, ["a", "b", "c/d"])):
+            os.mkdir(os.path.join(root, "c"))
+            for file_name in files:
+                with open(os.path.join(root, file_name), "w") as f:
+                    f.write(file_name)
+        with open(os.path.join(local, "c", "d"), "w") as f:
+            f.write("c/x")
+
+        result = compare_trees(local, source, DigestCache())
+
+        assert result.same == ["a"]
+        assert result.changed == ["c/d"]
+        assert result.added == ["b"]
+        assert result.removed == ["c/e"]
+
+
+def test_check_nested_directory():
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = NestedDirectoryDownloaderSnipty(project_root)
+        snipty.install_package(url="http://test.url/dir", name="multi")
+        assert snipty.check("multi") == 0
+
+        with open(os.path.join(project_root, "multi", "sub", "b.py"), "a") as f:
+            f.write("diff")
+        assert snipty.check("multi") == 1
+
+
+def test_check_directory_with_local_only_file():
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = NestedDirectoryDownloaderSnipty(project_root)
+        snipty.install_package(url="http://test.url/dir", name="multi")
+        with open(os.path.join(project_root, "multi", "extra.py"), "w") as f:
+            f.write("extra")
+        assert snipty.check("multi") == 1
+
+
+def test_snipty_list_parallel():
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = NestedDirectoryDownloaderSnipty(project_root)
+        snipty.install_package(url="http://test.url/dir1", name="multi1")
+        snipty.install_package(url="http://test.url/dir2", name="multi2")
+        with open(os.path.join(project_root, "multi2", "a.py"), "a") as f:
+            f.write("diff")
+
+        serial = NestedDirectoryDownloaderSnipty(project_root).list()
+        parallel = NestedDirectoryDownloaderSnipty(project_root).list(workers=4)
+
+        assert parallel == serial
+        assert serial["installed"][0][1] != serial["installed"][1][1]
+
+
+def test_verify_results():
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = NestedDirectoryDownloaderSnipty(project_root)
+        snipty.install_package(url="http://test.url/dir1", name="multi1")
+        snipty.install_package(url="http://test.url/dir2", name="multi2")
+        with open(os.path.join(project_root, "multi2", "a.py"), "a") as f:
+            f.write("diff")
+
+        results = snipty.verify()
+
+        assert [(r.name, r.status) for r in results] == [
+            ("multi1", SnippetStatus.UP_TO_DATE),
+            ("multi2", SnippetStatus.CHANGED),
+        ]
+        assert results[1].files == (
+            FileResult("a.py", FileStatus.CHANGED),
+            FileResult("sub/b.py", FileStatus.SAME),
+        )
+        assert results[0].local_hash == results[0].upstream_hash
+        assert results[1].local_hash != results[1].upstream_hash
+        assert results[0].duration > 0
+
+
+def test_verify_reports_download_errors():
+    class ErrorDownloader(DummyDownloader):
+        @classmethod
+        def download(cls, url: str) -> str:
+            if url.endswith("1.txt"):
+                raise DownloaderError("gone")
+            return super().download(url)
+
+    class TestSnipty(Snipty):
+        SUPPORTED_DOWNLOADERS = [ErrorDownloader]
+
+    with tempfile.TemporaryDirectory() as project_root:
+        with open(os.path.join(project_root, "snipty.yml"), "w") as f:
+            f.write("1.py: http://test.url/1.txt\n2.py: http://test.url/2.txt\n")
+        snipty = TestSnipty(project_root)
+        DummyDownloaderSnipty(project_root).install_missing(names=["2.py"])
+
+        results = snipty.verify()
+        assert [(r.status, r.error) for r in results] == [
+            (SnippetStatus.ERROR, "gone"),
+            (SnippetStatus.UP_TO_DATE, None),
+        ]
+
+        with pytest.raises(SniptyCriticalError):
+            snipty.check_all()
+
+
+def test_config_reloaded_when_changed_on_disk():
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = DummyDownloaderSnipty(project_root)
+        snipty.install_package(url="http://test.url/1.txt", name="1.py")
+        assert list(snipty.config()) == ["1.py"]
+
+        DummyDownloaderSnipty(project_root).install_package(
+            url="http://test.url/2.txt", name="2.py"
+        )
+        assert sorted(snipty.config()) == ["1.py", "2.py"]
+
+
+def test_verify_shared_between_threads():
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = DummyDownloaderSnipty(project_root)
+        for number in range(5):
+            snipty.install_package(
+                url="http://test.url/{}.txt".format(number), name="{}.py".format(number)
+            )
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(snipty.verify()))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(results) == 4
+        assert all(r.up_to_date for result in results for r in result)
+
+
+def test_affected_snippets():
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = NestedDirectoryDownloaderSnipty(project_root)
+        snipty.install_package(url="http://test.url/dir", name="lib/multi")
+        DummyDownloaderSnipty(project_root).install_package(
+            url="http://test.url/1.txt", name="lib/one.py"
+        )
+        snipty = Snipty(project_root)
+
+        def affected(*paths):
+            return snipty.affected_snippets(
+                [os.path.join(project_root, path) for path in paths]
+            )
+
+        assert affected("lib/multi/sub/b.py", "README.md") == ["lib/multi"]
+        assert affected("lib/one.py") == ["lib/one.py"]
+        assert affected("lib/__init__.py", "lib/multiple.py") == []
+        assert affected("snipty.yml") == ["lib/multi", "lib/one.py"]
+
+        # Relative paths are relative to project root, not current directory
+        assert snipty.affected_snippets(["lib/one.py"]) == ["lib/one.py"]
+
+
+def test_affected_snippets_warns_about_paths_outside_root(caplog):
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = DummyDownloaderSnipty(project_root)
+        snipty.install_package(url="http://test.url/1.txt", name="1.py")
+
+        assert snipty.affected_snippets(["../1.py"]) == []
+        assert "outside of project root" in caplog.text
+
+
+def test_staged_snippets():
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = DummyDownloaderSnipty(project_root)
+        snipty.install_package(url="http://test.url/1.txt", name="1.py")
+        snipty.install_package(url="http://test.url/2.txt", name="2.py")
+        subprocess.check_call(["git", "init", "-q", project_root])
+        assert snipty.staged_snippets() == []
+
+        with open(os.path.join(project_root, "2.py"), "a") as f:
+            f.write("diff")
+        subprocess.check_call(["git", "add", "2.py"], cwd=project_root)
+        assert snipty.staged_snippets() == ["2.py"]
+        assert snipty.check_all(names=snipty.staged_snippets()) == 1
+
+
+def test_staged_snippets_with_relative_root(monkeypatch):
+    with tempfile.TemporaryDirectory() as top:
+        project_root = os.path.join(top, "proj")
+        os.makedirs(project_root)
+        DummyDownloaderSnipty(project_root).install_package(
+            url="http://test.url/1.txt", name="helpers/a.py"
+        )
+        subprocess.check_call(["git", "init", "-q", project_root])
+        subprocess.check_call(["git", "add", "helpers/a.py"], cwd=project_root)
+
+        monkeypatch.chdir(top)
+        assert Snipty("proj").staged_snippets() == ["helpers/a.py"]
+
+
+def test_shard_names_partition():
+    names = ["snippet{}.py".format(number) for number in range(50)]
+    shards = [shard_names(names, index, 4) for index in range(1, 5)]
+
+    assert sorted(sum(shards, [])) == sorted(names)
+    assert all(shards)
+    assert shards[0] == shard_names(reversed(names), 1, 4)[::-1]
+
+
+def test_shard_names_weighted_by_timings():
+    names = ["a", "b", "c", "d", "e"]
+    timings = {"a": 10, "b": 6, "c": 4, "d": 1}
+    shards = [shard_names(names, index, 2, timings=timings) for index in (1, 2)]
+
+    assert shards == [["a", "c"], ["b", "d", "e"]]
+
+
+def test_parse_shard():
+    assert parse_shard("2/3") == (2, 3)
+    for value in ("0/3", "4/3", "1", "a/b"):
+        with pytest.raises(ValueError):
+            parse_shard(value)
+
+
+def test_single_flight_coalesces_concurrent_downloads():
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.1)
+        return DummyDownloader.download("http://test.url/1.txt")
+
+    with SingleFlight() as downloads:
+        paths = []
+        threads = [
+            threading.Thread(
+                target=lambda: paths.append(downloads.download("key", fetch))
+            )
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(calls) == 1
+        assert len(set(paths)) == 5
+        for path in paths:
+            assert_file_content(path, "test")
+
+
+def test_single_flight_shares_errors():
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        raise DownloaderError("gone")
+
+    with SingleFlight() as downloads:
+        for _ in range(2):
+            with pytest.raises(DownloaderError):
+                downloads.download("key", fetch)
+    assert len(calls) == 1
+
+
+def test_single_flight_install_and_check():
+    CountingDownloader.calls = 0
+    with tempfile.TemporaryDirectory() as project_root, SingleFlight() as downloads:
+        snipty = CountingDownloaderSnipty(project_root, downloads=downloads)
+        snipty.install_package(url="http://test.url/1.txt", name="1.py")
+        assert snipty.check("1.py") == 0
+        assert snipty.check_all() == 0
+        assert CountingDownloader.calls == 1
+
+
+def test_normalize_url():
+    assert (
+        BasicDownloader.normalize_url("HTTPS://Example.com:443/a/")
+        == "https://example.com/a"
+    )
+    assert GhostbinDownloader.normalize_url(
+        "https://ghostbin.com/paste/abc/raw"
+    ) == GhostbinDownloader.normalize_url("https://ghostbin.com/paste/abc")
+    assert GistDownloader.normalize_url(
+        "https://gist.github.com/alice/a1"
+    ) == GistDownloader.normalize_url("https://gist.github.com/a1/")
+
+
+def git_commit(repository, files):
+    for name, content in files.items():
+        path = os.path.join(repository, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+    subprocess.check_call(["git", "add", "."], cwd=repository)
+    subprocess.check_call(
+        ["git", "-c", "user.name=t", "-c", "user.email=t@t", "commit", "-q", "-m", "-"],
+        cwd=repository,
+    )
+
+
+@pytest.fixture
+def git_repository(monkeypatch):
+    with tempfile.TemporaryDirectory() as repository, tempfile.TemporaryDirectory() as cache:
+        monkeypatch.setenv("SNIPTY_GIT_CACHE", cache)
+        subprocess.check_call(["git", "init", "-q", repository])
+        git_commit(
+            repository,
+            {"helpers/a.py": "a", "helpers/b.py": "b", "helpers/sub/c.py": "c"},
+        )
+        yield repository
+
+
+def test_git_downloader_single_fetch_per_repository(git_repository, monkeypatch):
+    commands = []
+
+    def counting_run_git(*args, **kwargs):
+        commands.append(args[0])
+        return run_git(*args, **kwargs)
+
+    monkeypatch.setattr("snipty.downloaders.run_git", counting_run_git)
+    url = "git+file://{}#helpers/{}"
+
+    with tempfile.TemporaryDirectory() as project_root, SingleFlight() as run:
+        snipty = Snipty(project_root, downloads=run)
+        snipty.install_package(url=url.format(git_repository, "a.py"), name="a.py")
+        snipty.install_package(url=url.format(git_repository, "b.py"), name="b.py")
+        snipty.install_package(url=url.format(git_repository, "sub"), name="sub")
+
+        assert_file_content(os.path.join(project_root, "a.py"), "a")
+        assert_file_content(os.path.join(project_root, "sub", "c.py"), "c")
+        assert snipty.check_all() == 0
+        assert commands.count("fetch") == 1
+        assert commands.count("ls-remote") == 1
+
+        git_commit(git_repository, {"helpers/b.py": "changed"})
+        # Refs are resolved once per run
+        assert snipty.check_all() == 0
+        assert Snipty(project_root).check_all() == 1
+        assert commands.count("fetch") == 2
+
+        # Without given run every call resolves refs again
+        git_commit(git_repository, {"helpers/b.py": "again"})
+        assert Snipty(project_root).check_all() == 1
+        assert commands.count("fetch") == 3
+
+
+def test_git_downloader_refs(git_repository):
+    subprocess.check_call(["git", "tag", "v1"], cwd=git_repository)
+    git_commit(git_repository, {"helpers/a.py": "a2"})
+    url = "git+file://{}#helpers/a.py".format(git_repository)
+
+    assert_file_content(GitDownloader.download(url + "@v1"), "a")
+    assert_file_content(GitDownloader.download(url), "a2")
+
+    with pytest.raises(DownloaderError):
+        GitDownloader.download(url + "@missing")
+    with pytest.raises(DownloaderError):
+        GitDownloader.download("git+file://{}#nope.py".format(git_repository))
+
+    # Path containing "@" with explicit ref
+    git_commit(git_repository, {"js/@scope/util.js": "u"})
+    assert_file_content(
+        GitDownloader.download(
+            "git+file://{}#js/@scope/util.js@HEAD".format(git_repository)
+        ),
+        "u",
+    )
+
+    assert GitDownloader.normalize_url(
+        "git+FILE://{}/#helpers/a.py".format(git_repository)
+    ) == GitDownloader.normalize_url(url + "@HEAD")
+
+
+def test_metrics_recorded_for_install_and_check():
+    CountingDownloader.calls = 0
+    metrics = Metrics()
+    with tempfile.TemporaryDirectory() as project_root, SingleFlight() as downloads:
+        snipty = CountingDownloaderSnipty(
+            project_root, downloads=downloads, metrics=metrics
+        )
+        snipty.install_package(url="http://test.url/1.txt", name="1.py")
+        snipty.config(create=True)["2.py"] = "http://test.url/2.txt"
+        snipty.store_config()
+        assert snipty.check_all() == 1
+
+    labels = dict(downloader="CountingDownloader", host="test.url")
+    assert metrics.value("snipty_snippets_installed_total") == 1
+    assert metrics.value("snipty_snippets_checked_total", status="up_to_date") == 1
+    assert metrics.value("snipty_snippets_checked_total", status="changed") == 1
+    assert metrics.value("snipty_snippets_missing_total") == 1
+    assert metrics.value("snipty_download_cache_hits_total") == 1
+    assert metrics.value("snipty_download_duration_seconds", **labels) == 2
+    assert metrics.value("snipty_download_bytes_total", **labels) == 8
+
+
+def test_metrics_render_and_write():
+    metrics = Metrics()
+    with recording(metrics):
+        record_http_response("https://gist.github.com/a1", 404)
+    metrics.observe("snipty_download_duration_seconds", 0.2, host='a"b')
+
+    rendered = metrics.render()
+    assert "# TYPE snipty_http_responses_total counter" in rendered
+    assert (
+        'snipty_http_responses_total{code="404",host="gist.github.com"} 1' in rendered
+    )
+    assert (
+        'snipty_download_duration_seconds_bucket{host="a\\"b",le="0.1"} 0' in rendered
+    )
+    assert (
+        'snipty_download_duration_seconds_bucket{host="a\\"b",le="0.25"} 1' in rendered
+    )
+    assert 'snipty_download_duration_seconds_count{host="a\\"b"} 1' in rendered
+
+    with pytest.raises(KeyError):
+        metrics.inc("unknown_total")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "snipty.prom")
+        metrics.write(path)
+        assert os.listdir(directory) == ["snipty.prom"]
+        assert_file_content(path, rendered)
+
+
+class SnippetRequestHandler(BaseHTTPRequestHandler):
+    # path: (content type, body, send Content-Length)
+    RESPONSES = {
+        "/small.py": ("text/plain", b"a" * 600, True),
+        "/other.py": ("text/plain", b"b" * 600, True),
+        "/large.py": ("text/plain", b"c" * 5000, True),
+        "/unknown-size.py": ("text/plain", b"d" * 5000, False),
+        "/octet.py": ("application/octet-stream", "zażółć".encode("utf-8"), True),
+        "/binary.py": ("application/octet-stream", b"\0\1\2", True),
+    }
+
+    def do_GET(self):
+        content_type, body, content_length = self.RESPONSES[self.path]
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        if content_length:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def snippet_server(monkeypatch):
+    server = HTTPServer(("127.0.0.1", 0), SnippetRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        monkeypatch.setenv("SNIPTY_TMP", tmp)
+        yield "http://127.0.0.1:{}".format(server.server_address[1]), tmp
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_snippet_size_limit(snippet_server):
+    url, tmp = snippet_server
+    policy = DownloadPolicy(max_snippet_bytes=1000)
+
+    for path in ("/large.py", "/unknown-size.py"):
+        with policy.downloading(), pytest.raises(DownloaderError):
+            BasicDownloader.download(url + path)
+        # Nothing left behind by aborted downloads
+        assert os.listdir(tmp) == []
+
+    with policy.downloading():
+        assert_file_content(BasicDownloader.download(url + "/small.py"), "a" * 600)
+
+
+def test_download_run_size_limit(snippet_server):
+    url, tmp = snippet_server
+    policy = DownloadPolicy(max_run_bytes=1000)
+    with tempfile.TemporaryDirectory() as project_root:
+        with SingleFlight() as run:
+            snipty = Snipty(project_root, downloads=run, policy=policy)
+            snipty.install_package(url=url + "/small.py", name="small.py")
+
+            with pytest.raises(SniptyCriticalError) as e:
+                snipty.install_package(url=url + "/other.py", name="other.py")
+            assert e.value.code == 6
+            with run.activated():
+                assert policy.run_usage().size == 600
+
+        # Budget is not carried over to the next run
+        Snipty(project_root, policy=policy).install_package(
+            url=url + "/other.py", name="other.py"
+        )
+        assert_file_content(os.path.join(project_root, "other.py"), "b" * 600)
+
+
+def test_download_policy_from_invalid_environment(monkeypatch):
+    monkeypatch.setenv("SNIPTY_MAX_SNIPPET_BYTES", "abc")
+    with pytest.raises(ValueError) as e:
+        DownloadPolicy.from_environment()
+    assert "SNIPTY_MAX_SNIPPET_BYTES" in str(e.value)
+
+
+def test_mirror_fetches_within_policy(snippet_server):
+    url, tmp = snippet_server
+    server, mirror_url = start_mirror(
+        [BasicDownloader],
+        allowed_hosts=["127.0.0.1"],
+        policy=DownloadPolicy(max_snippet_bytes=1000),
+    )
+    try:
+        assert_file_content(fetch_from_mirror(mirror_url, url + "/small.py"), "a" * 600)
+        with pytest.raises(DownloaderError):
+            fetch_from_mirror(mirror_url, url + "/large.py")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_gist_download_limits(monkeypatch):
+    responses = {}
+    read = []
+
+    class Response:
+        status_code = 200
+        headers = {}
+
+        def __init__(self, url):
+            self.body = responses[url]
+
+        def iter_content(self, chunk_size):
+            for start in range(0, len(self.body), 16):
+                read.append(start)
+                yield self.body[start : start + 16]
+
+        def close(self):
+            pass
+
+    def gist(gist_id, content, history=()):
+        files = {"a.py": {"filename": "a.py", "size": len(content), "content": content}}
+        responses["https://api.github.com/gists/" + gist_id] = json.dumps(
+            {"files": files, "history": list(history)}
+        ).encode("utf-8")
+        return "https://gist.github.com/alice/" + gist_id
+
+    monkeypatch.setattr(
+        "snipty.downloaders.requests.get", lambda url, stream=False: Response(url)
+    )
+    monkeypatch.setattr(GistDownloader, "RESPONSE_METADATA_BYTES", 100)
+    policy = DownloadPolicy(max_snippet_bytes=512)
+
+    # Escaping makes response larger than the snippet limit, contents are within it
+    url = gist("quoted", '"\n' * 200)
+    with policy.downloading():
+        assert_file_content(GistDownloader.download(url), '"\n' * 200)
+
+    url = gist("large", "a" * 600)
+    with policy.downloading(), pytest.raises(DownloaderError):
+        GistDownloader.download(url)
+
+    # Response is not read beyond its envelope
+    url = gist("history", "a", history=["x" * 100] * 100)
+    read.clear()
+    with policy.downloading(), pytest.raises(DownloaderError):
+        GistDownloader.download(url)
+    assert len(read) * 16 < 512 * 2 + 100 + 32
+
+
+def test_download_content_sniffing(snippet_server):
+    url, tmp = snippet_server
+
+    with pytest.raises(DownloaderError):
+        BasicDownloader.download(url + "/octet.py")
+
+    with DownloadPolicy(sniff_content=True).downloading():
+        path = BasicDownloader.download(url + "/octet.py")
+        with open(path, encoding="utf-8") as f:
+            assert f.read() == "zażółć"
+
+        with pytest.raises(DownloaderError):
+            BasicDownloader.download(url + "/binary.py")
+
+
+def test_parse_size():
+    assert parse_size("512") == 512
+    assert parse_size("64k") == 64 * 1024
+    assert parse_size("10M") == 10 * 1024 * 1024
+    assert parse_size("0") is None
+    with pytest.raises(ValueError):
+        parse_size("ten")
+
+
+def test_compare_files():
+    with tempfile.TemporaryDirectory() as directory:
+        local_path = os.path.join(directory, "local")
+        source_path = os.path.join(directory, "source")
+
+        def compare(local, source):
+            for path, content in ((local_path, local), (source_path, source)):
+                with open(path, "wb") as f:
+                    f.write(content)
+            return compare_files(local_path, source_path)
+
+        assert compare(b"", b"").same
+        assert compare(b"a" * 100000, b"a" * 100000).same
+
+        result = compare(b"abc", b"abcd")
+        assert not result.same and result.offset is None
+        assert (result.local_size, result.source_size) == (3, 4)
+
+        # Difference in the second comparison window
+        assert (
+            compare(b"a" * 100000, b"a" * 70001 + b"b" + b"a" * 29998).offset == 70001
+        )
+        assert compare(b"xbc", b"abc").offset == 0
+        # Last window not aligned to words
+        assert compare(b"a" * 65541, b"a" * 65540 + b"b").offset == 65540
+
+
+def test_check_single_file_reports_first_difference():
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = DummyDownloaderSnipty(project_root)
+        snipty.install_package(url="http://test.url/1.txt", name="1.py")
+        with open(os.path.join(project_root, "1.py"), "w") as f:
+            f.write("tesT")
+
+        (result,) = snipty.verify(print_diff=True)
+        assert result.status == SnippetStatus.CHANGED
+        assert result.first_difference == 3
+
+
+def test_check_hashes_only_on_request():
+    class CountingSnipty(DummyDownloaderSnipty):
+        hashed = []
+
+        def _path_checksum(self, full_path, digests=None):
+            self.hashed.append(full_path)
+            return super()._path_checksum(full_path, digests)
+
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = CountingSnipty(project_root)
+        snipty.install_package(url="http://test.url/1.txt", name="1.py")
+        snipty.hashed.clear()
+
+        assert snipty.check_all() == 0
+        assert snipty.hashed == []
+
+        # Upstream copy of up to date snippet is not hashed again
+        (result,) = snipty.verify()
+        assert result.local_hash == result.upstream_hash
+        assert snipty.hashed == [os.path.join(project_root, "1.py")]
+
+
+def test_print_diff_binary_and_large_files(capsys):
+    with tempfile.TemporaryDirectory() as directory:
+        old_path = os.path.join(directory, "old")
+        new_path = os.path.join(directory, "new")
+        snipty = Snipty(directory)
+
+        with open(old_path, "wb") as f:
+            f.write(b"caf\xe9\nline\n")
+        with open(new_path, "wb") as f:
+            f.write(b"cafe\nline\n")
+        snipty._print_diff(old_path, new_path)
+        err = capsys.readouterr().err
+        assert err.startswith("Diff of {}:".format(old_path))
+        assert "+ cafe" in err
+
+        snipty._print_diff(old_path, new_path, diff_limit=5)
+        assert "too large to diff" in capsys.readouterr().err
+
+        with open(new_path, "wb") as f:
+            f.write(b"\0\1\2")
+        snipty._print_diff(old_path, new_path)
+        assert "Binary files differ." in capsys.readouterr().err
+
+
+def test_git_downloader_refuses_option_injection(git_repository, tmp_path):
+    marker = tmp_path / "pwned"
+    for url in (
+        "git+--upload-pack=touch {};git-upload-pack#a.py@{}".format(
+            marker, git_repository
+        ),
+        "git+ext::sh -c touch% {}#a.py".format(marker),
+        "git+file://{}#helpers/a.py@--upload-pack=touch {}".format(
+            git_repository, marker
+        ),
+    ):
+        with pytest.raises(DownloaderError):
+            GitDownloader.download(url)
+    assert not marker.exists()
+
+
+def test_mirror_sees_git_branch_updates(git_repository):
+    cache = MirrorCache(
+        [GitDownloader], ttl=0, allowed_hosts=[""], allowed_schemes=["git+file"]
+    )
+    url = "git+file://{}#helpers/a.py".format(git_repository)
+
+    assert cache.get(url).payload == b"a"
+    git_commit(git_repository, {"helpers/a.py": "a2"})
+    assert cache.get(url).payload == b"a2"
+
+
+def test_install_missing_with_nested_directory():
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = NestedDirectoryDownloaderSnipty(project_root)
+        snipty.install_package(url="http://test.url/dir", name="multi")
+        stale_path = os.path.join(project_root, "multi", "sub", "stale.py")
+        open(stale_path, "w").close()
+
+        # Installed directory snippet is not missing
+        snipty.install_missing()
+        assert os.path.exists(stale_path)
+
+        snipty.install_missing(force=True)
+        assert not os.path.exists(stale_path)
+        assert snipty.check("multi") == 0
+
+
+def test_install_refuses_names_outside_project_root():
+    with tempfile.TemporaryDirectory() as top:
+        project_root = os.path.join(top, "project")
+        os.makedirs(os.path.join(project_root, "src"))
+        important_path = os.path.join(project_root, "src", "important.py")
+        open(important_path, "w").close()
+        outside_path = os.path.join(top, "outside")
+        os.makedirs(outside_path)
+        snipty = NestedDirectoryDownloaderSnipty(project_root)
+
+        for name in (".", "src/..", "../outside", outside_path):
+            with pytest.raises(SniptyCriticalError) as e:
+                snipty.install_package(url="http://test.url/dir", name=name, force=True)
+            assert e.value.code == 3
+
+        # Names listed in a shared snipty.yml are refused as well
+        with open(os.path.join(project_root, "snipty.yml"), "w") as f:
+            f.write(".: http://test.url/dir\n")
+        with pytest.raises(SniptyCriticalError):
+            snipty.install_missing(force=True)
+
+        assert os.path.exists(important_path)
+        assert os.path.isdir(outside_path)
+
+
+def test_gist_probe_limits_listing_per_owner(monkeypatch):
+    requested = []
+
+    class Response:
+        status_code = 200
+        links = {}
+
+        def __init__(self, url):
+            self.url = url
+
+        def json(self):
+            if "/bob/" in self.url:
+                return [{"id": "b1", "updated_at": "2018-01-01T00:00:00Z"}]
+            return []
+
+    def get(url, params=None):
+        requested.append((url, params))
+        return Response(url)
+
+    monkeypatch.setattr("snipty.downloaders.requests.get", get)
+
+    validators = GistDownloader.probe(
+        [
+            "https://gist.github.com/alice/a1",
+            "https://gist.github.com/alice/a2",
+            "https://gist.github.com/bob/b1",
+        ],
+        since={
+            "https://gist.github.com/alice/a1": 2000000000,
+            "https://gist.github.com/alice/a2": 1500000000,
+        },
+    )
+
+    assert validators == {
+        "https://gist.github.com/alice/a1": NOT_MODIFIED,
+        "https://gist.github.com/alice/a2": NOT_MODIFIED,
+        "https://gist.github.com/bob/b1": "2018-01-01T00:00:00Z",
+    }
+    # New gist of bob does not force full listing of alice's gists
+    assert requested == [
+        (
+            "https://api.github.com/users/alice/gists",
+            {"per_page": 100, "since": "2017-07-14T02:40:00Z"},
+        ),
+        ("https://api.github.com/users/bob/gists", {"per_page": 100}),
+    ]
+
+
+class ProbingOnlyDownloader(ProbingDownloader):
+    @classmethod
+    def match(cls, url: str) -> bool:
+        return url.startswith("http://probe.url/")
+
+
+class MixedDownloadersSnipty(Snipty):
+    SUPPORTED_DOWNLOADERS = [ProbingOnlyDownloader, DummyDownloader]
+
+
+def test_check_incremental_probes_only_probing_downloaders():
+    with tempfile.TemporaryDirectory() as project_root:
+        snipty = MixedDownloadersSnipty(project_root)
+        snipty.install_package(url="http://probe.url/1.txt", name="1.py")
+        snipty.install_package(url="http://test.url/2.txt", name="2.py")
+        ProbingDownloader.probes = []
+
+        assert snipty.check_all(incremental=True) == 0
+        assert snipty.check_all(incremental=True, max_age=0) == 0
+        # Url of not probing downloader does not prevent limiting the probe
+        assert ProbingDownloader.probes == [
+            {},
+            {
+                "http://probe.url/1.txt": ProbingDownloader.probes[1][
+                    "http://probe.url/1.txt"
+                ]
+            },
+        ]